@@ -0,0 +1,368 @@
+"""
+Copyright (c) 2013 Timon Wong
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import asyncio
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_to_bytes
+
+from . import log
+from .Setting import Setting
+from .RendererManager import RenderedMarkupCache
+
+from bottle import ServerAdapter
+
+# asyncio.Task.all_tasks() was removed in python 3.9
+all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+
+
+class AsyncioServer(ServerAdapter):
+    """HTTP/1.1 server running on a single asyncio event loop.
+
+    Long polling queries are held on the event loop, so idle preview tabs
+    don't take a thread each; requests are then handed over to the WSGI app
+    running on a thread pool of at most `max_threads` threads.
+    """
+
+    # Seconds to keep idle keep-alive connections open
+    KEEP_ALIVE_TIMEOUT = 15
+
+    def __init__(self, host='127.0.0.1', port=8080, **options):
+        super(AsyncioServer, self).__init__(host=host, port=port, **options)
+        self.loop = None
+        self.executor = None
+        self.handler = None
+        # Futures of long polling queries, resolved upon cache changes
+        self.waiters = set()
+        self.stats = {
+            'connections': 0,
+            'requests': 0,
+            'long_polls': 0,
+            'max_long_polls': 0,
+        }
+
+    def run(self, handler):
+        self.handler = handler
+        self.loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.executor = ThreadPoolExecutor(max(1, self.options.get('max_threads', 16)))
+        cache = RenderedMarkupCache.instance()
+        cache.add_listener(self._on_cache_changed)
+        try:
+            server = loop.run_until_complete(
+                asyncio.start_server(self._serve_connection, self.host, self.port))
+            loop.run_forever()
+            server.close()
+            tasks = all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            cache.remove_listener(self._on_cache_changed)
+            self.executor.shutdown(wait=False)
+            loop.close()
+
+    def shutdown(self):
+        try:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        except (AttributeError, RuntimeError):
+            # Not started or already closed
+            pass
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['backend'] = 'asyncio'
+        stats['max_threads'] = self.options.get('max_threads', 16)
+        return stats
+
+    def _on_cache_changed(self):
+        # Called from any thread
+        try:
+            self.loop.call_soon_threadsafe(self._wake_waiters)
+        except RuntimeError:
+            pass
+
+    def _wake_waiters(self):
+        waiters, self.waiters = self.waiters, set()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _serve_connection(self, reader, writer):
+        self.stats['connections'] += 1
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                                  self.KEEP_ALIVE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    return
+                request = self._parse_head(head)
+                if request is None:
+                    writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n'
+                                 b'Connection: close\r\n\r\n')
+                    await writer.drain()
+                    return
+                method, target, version, headers = request
+                length = int(headers.get('content-length') or 0)
+                body = await reader.readexactly(length) if length > 0 else b''
+                connection = headers.get('connection', '').lower()
+                if version == 'HTTP/1.0':
+                    keep_alive = connection == 'keep-alive'
+                else:
+                    keep_alive = connection != 'close'
+
+                self.stats['requests'] += 1
+                if method == 'POST' and target.split('?')[0] == '/api/query':
+                    body = await self._wait_query(body)
+                environ = self._make_environ(method, target, version, headers, body,
+                                             writer.get_extra_info('peername'))
+                keep_alive = await self._send_response(writer, environ, method, version,
+                                                       keep_alive)
+                if not keep_alive:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.stats['connections'] -= 1
+            writer.close()
+
+    async def _wait_query(self, body):
+        """Hold a long polling query until the buffer changes.
+
+        Returns the request body, with `wait` cleared, so the app answers
+        without blocking a thread.
+        """
+        try:
+            obj = json.loads(body.decode('utf-8'))
+            buffer_id = obj['buffer_id']
+            timestamp = str(obj['timestamp'])
+        except Exception:
+            return body
+        if not obj.get('wait'):
+            return body
+        timeout = Setting.instance().long_polling_timeout
+        deadline = self.loop.time() + timeout
+        cache = RenderedMarkupCache.instance()
+        self.stats['long_polls'] += 1
+        self.stats['max_long_polls'] = max(self.stats['max_long_polls'], self.stats['long_polls'])
+        try:
+            while True:
+                entry = cache.get_entry(buffer_id)
+                if entry is None or entry.disconnected or entry.timestamp != timestamp:
+                    break
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                waiter = self.loop.create_future()
+                self.waiters.add(waiter)
+                try:
+                    await asyncio.wait_for(waiter, remaining)
+                except asyncio.TimeoutError:
+                    break
+                finally:
+                    self.waiters.discard(waiter)
+        finally:
+            self.stats['long_polls'] -= 1
+        obj['wait'] = False
+        return json.dumps(obj).encode('utf-8')
+
+    def _parse_head(self, head):
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                return None
+            headers[name.strip().lower()] = value.strip()
+        return method.upper(), target, version.upper(), headers
+
+    def _make_environ(self, method, target, version, headers, body, peername):
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            # PEP 3333: url-decoded bytes as latin-1
+            'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peername[0] if peername else '',
+            'CONTENT_LENGTH': str(len(body)),
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = value
+        return environ
+
+    async def _send_response(self, writer, environ, method, version, keep_alive):
+        """Run the app on the thread pool, and send its content as it's produced.
+
+        Content of a known length is sent as is, other content is sent with
+        chunked transfer encoding (or until the connection is closed for HTTP/1.0
+        clients). Returns whether the connection may be kept alive.
+        """
+        result = None
+        head_sent = False
+        try:
+            status, headers, result, chunks = await self.loop.run_in_executor(
+                self.executor, self._start_app, environ)
+            length = 0 if method == 'HEAD' else self._content_length(headers)
+            chunked = False
+            buffered = []
+            if length is None:
+                # Content of a single chunk is sent with its length
+                for i in range(2):
+                    chunk = await self.loop.run_in_executor(
+                        self.executor, self._next_chunk, chunks)
+                    if chunk is None:
+                        length = sum(len(data) for data in buffered)
+                        break
+                    buffered.append(chunk)
+                else:
+                    if version == 'HTTP/1.1':
+                        chunked = True
+                    else:
+                        keep_alive = False
+            writer.write(self._make_head(status, headers, method, keep_alive, length,
+                                         chunked))
+            head_sent = True
+            if method == 'HEAD':
+                await writer.drain()
+                return keep_alive
+            while True:
+                if buffered:
+                    chunk = buffered.pop(0)
+                else:
+                    chunk = await self.loop.run_in_executor(
+                        self.executor, self._next_chunk, chunks)
+                if chunk is None:
+                    break
+                if chunked:
+                    writer.write(('%x\r\n' % len(chunk)).encode('ascii'))
+                    writer.write(chunk)
+                    writer.write(b'\r\n')
+                else:
+                    writer.write(chunk)
+                # Don't let the app get ahead of slow clients
+                await writer.drain()
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+            return keep_alive
+        except ConnectionError:
+            raise
+        except Exception:
+            log.exception('Error on serving %s', environ['PATH_INFO'])
+            if head_sent:
+                # The content is incomplete, let the client know by closing
+                return False
+            writer.write(self._make_head('500 Internal Server Error', [], method,
+                                         keep_alive, 0))
+            await writer.drain()
+            return keep_alive
+        finally:
+            if hasattr(result, 'close'):
+                try:
+                    result.close()
+                except Exception:
+                    log.exception('Error on closing response of %s', environ['PATH_INFO'])
+
+    def _start_app(self, environ):
+        """Call the app, returns (status, headers, result, chunks iterator)."""
+        response = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return written.append
+
+        result = self.handler(environ, start_response)
+
+        def chunks():
+            # Data passed to write() goes first
+            for chunk in result:
+                while written:
+                    yield written.pop(0)
+                yield chunk
+            while written:
+                yield written.pop(0)
+
+        return response['status'], response['headers'], result, chunks()
+
+    @staticmethod
+    def _next_chunk(chunks):
+        """Get the next non-empty chunk of content, None when exhausted."""
+        for chunk in chunks:
+            if chunk:
+                return chunk
+        return None
+
+    @staticmethod
+    def _content_length(headers):
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                try:
+                    return int(value)
+                except ValueError:
+                    return None
+        return None
+
+    def _make_head(self, status, headers, method, keep_alive, length=None, chunked=False):
+        lines = ['HTTP/1.1 ' + status]
+        has_length = False
+        for name, value in headers:
+            lowered = name.lower()
+            if lowered in ('connection', 'transfer-encoding'):
+                continue
+            if lowered == 'content-length':
+                # Keep the length of the content HEAD requests would get
+                if method != 'HEAD':
+                    continue
+                has_length = True
+            lines.append('%s: %s' % (name, value))
+        if chunked:
+            lines.append('Transfer-Encoding: chunked')
+        elif length is not None and not has_length:
+            lines.append('Content-Length: %d' % length)
+        lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
@@ -23,7 +23,8 @@ SOFTWARE.
 import sys
 import re
 import copy
-from threading import Condition, Lock, current_thread
+from collections import deque
+from threading import Condition, Lock, Thread, current_thread
 from contextlib import contextmanager
 from time import time
 
@@ -94,6 +95,63 @@ def entities_unescape(text):
     return re.sub("&#?\w+;", fixup, text)
 
 
+HTML_TAG_RE = re.compile(r'<!--.*?-->|'
+                         r'<(/?)([a-zA-Z][a-zA-Z0-9:-]*)'
+                         r'((?:\s+[^\s"\'>/=]+(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s"\'>]+))?)*)'
+                         r'\s*(/?)>', re.DOTALL)
+HTML_VOID_ELEMENTS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                                'link', 'meta', 'param', 'source', 'track', 'wbr'])
+HTML_RAW_TEXT_ELEMENTS = frozenset(['script', 'style', 'textarea'])
+
+
+def split_html_blocks(html):
+    """Split an HTML fragment into its top-level elements.
+
+    Returns a list of HTML strings, one per top-level element, or None if the
+    fragment has anything else (text, comments) at the top level, or doesn't
+    look well-formed.
+    """
+    blocks = []
+    lowered_html = None
+    depth = 0
+    start = pos = 0
+    while True:
+        m = HTML_TAG_RE.search(html, pos)
+        if m is None:
+            break
+        if depth == 0 and html[pos:m.start()].strip():
+            return None
+        pos = m.end()
+        closing, tag = m.group(1), m.group(2)
+        if tag is None:
+            # Comment
+            if depth == 0:
+                return None
+            continue
+        tag = tag.lower()
+        if closing:
+            depth -= 1
+            if depth < 0:
+                return None
+        else:
+            if depth == 0:
+                start = m.start()
+            if tag in HTML_RAW_TEXT_ELEMENTS:
+                if lowered_html is None:
+                    lowered_html = html.lower()
+                end = lowered_html.find('</%s' % tag, pos)
+                if end < 0:
+                    return None
+                pos = end
+            if tag not in HTML_VOID_ELEMENTS and not m.group(4):
+                depth += 1
+        if depth == 0:
+            blocks.append(html[start:pos])
+    if depth != 0 or html[pos:].strip():
+        return None
+    return blocks
+
+
 class Singleton(object):
     def __init__(self, decorated):
         decorated.__lock_obj = thread.allocate_lock()
@@ -353,3 +411,41 @@ class Future(object):
             reraise(exc[0], exc[1], exc[2])
         result = self.__result
         return copy.deepcopy(result)
+
+
+class ThreadPool(object):
+    """Runs functions on up to `num_threads` daemon threads.
+
+    Threads are started on demand, and kept waiting for more work.
+    """
+
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self.cond = Condition()
+        self.queue = deque()
+        self.threads = 0
+        self.idle = 0
+
+    def submit(self, func, *args, **kwargs):
+        """Queue `func(*args, **kwargs)`, returns its Future."""
+        future = Future(func, *args, **kwargs)
+        with self.cond:
+            self.queue.append(future)
+            if len(self.queue) > self.idle and self.threads < self.num_threads:
+                self.threads += 1
+                thread = Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+            else:
+                self.cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.idle += 1
+                    self.cond.wait()
+                    self.idle -= 1
+                future = self.queue.popleft()
+            future()
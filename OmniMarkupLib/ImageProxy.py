@@ -0,0 +1,261 @@
+"""
+Copyright (c) 2013 Timon Wong
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from . import log
+from .Common import ThreadPool
+from .RenderCache import DiskCache, LRUCache, replace_file
+from .Renderers.base_renderer import get_startupinfo
+from .StaticFiles import STAT_CACHE
+
+# Images not larger than this (in bytes) are always served as is
+MIN_PROXIED_SIZE = 128 * 1024
+# Number of images failed to be resized which are remembered
+MAX_FAILURES = 1024
+
+
+def image_size(path):
+    """Get (width, height) of a PNG, GIF or JPEG image, from its header only.
+
+    Returns None for other formats, or if the header can't be parsed.
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(26)
+            if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+                return struct.unpack('>II', head[16:24])
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                return struct.unpack('<HH', head[6:10])
+            if head[:2] == b'\xff\xd8':
+                return jpeg_size(f)
+    except (IOError, OSError, struct.error):
+        pass
+    return None
+
+
+def jpeg_size(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) != 2 or marker[0:1] != b'\xff':
+            return None
+        code = ord(marker[1:2])
+        if code in (0xd8, 0x01) or 0xd0 <= code <= 0xd7:
+            # Markers without a length
+            continue
+        length = struct.unpack('>H', f.read(2))[0]
+        # Start Of Frame markers, except DHT, JPG and DAC
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack('>xHH', f.read(5))
+            return width, height
+        f.seek(length - 2, 1)
+
+
+def find_executable(name):
+    for dirname in os.environ.get('PATH', '').split(os.pathsep):
+        for ext in ('', '.exe'):
+            path = os.path.join(dirname, name + ext)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+
+def default_command():
+    """Converter available on this system out of the box, if any."""
+    if sys.platform == 'darwin':
+        return ['sips', '--resampleWidth', '{width}', '{input}', '--out', '{output}']
+    if os.name != 'nt' and find_executable('convert') is not None:
+        # ImageMagick
+        return ['convert', '{input}', '-resize', '{width}x>', '{output}']
+    return None
+
+
+class ThumbnailCache(DiskCache):
+    """Persistent cache of thumbnail files."""
+
+    SUFFIX = '.thumb'
+    # Access times are only recorded this often (in seconds), since touching
+    # a file changes its ETag as well
+    TOUCH_INTERVAL = 24 * 60 * 60
+
+    def get_filename(self, key):
+        """Get the thumbnail file for `key`, or None if not cached."""
+        filename = self._filename(key)
+        st = STAT_CACHE.stat(filename)
+        if st is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        if st.st_mtime < time.time() - self.TOUCH_INTERVAL:
+            try:
+                os.utime(filename, None)
+            except OSError:
+                pass
+            STAT_CACHE.invalidate(filename)
+        with self.lock:
+            self.hits += 1
+        return filename
+
+    def set_file(self, key, tmp_filename):
+        """Move `tmp_filename` into the cache as the thumbnail for `key`."""
+        filename = self._filename(key)
+        dirname = os.path.dirname(filename)
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            size = os.path.getsize(tmp_filename)
+            replace_file(tmp_filename, filename)
+        except (IOError, OSError):
+            log.exception('Error on writing thumbnail file: %s', filename)
+            os.remove(tmp_filename)
+            return None
+        with self.lock:
+            if self.size is not None:
+                self.size += size
+        self._evict()
+        return filename
+
+
+class ImageProxy(object):
+    """Downscales images wider than `max_width` for previews.
+
+    Images are resized with PIL if it can be imported and handles them, or
+    else by running `command` (or a converter found on the system), whose
+    arguments may contain {input}, {output} and {width}. Resizing happens in
+    the background, images are served as is until their resized copy is
+    ready, or if they can't be resized.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.max_width = 0
+        self.command = None
+        self.cache = ThumbnailCache()
+        # Keys of images failed to be resized, not retried until evicted
+        self.failures = LRUCache(MAX_FAILURES, sizeof=lambda value: 1)
+        # Keys of images being resized
+        self.resizing = set()
+        self.pool = ThreadPool(2)
+
+    def configure(self, cache_dir, max_width, command, max_bytes):
+        with self.lock:
+            self.max_width = max_width
+            self.command = command or default_command()
+            self.failures.clear()
+        self.cache.configure(cache_dir, max_bytes)
+
+    def get(self, path):
+        """Get the path of a downscaled copy of `path`, or None."""
+        max_width = self.max_width
+        if max_width <= 0 or not self.cache.enabled:
+            return None
+        st = STAT_CACHE.stat(path)
+        if st is None or st.st_size <= MIN_PROXIED_SIZE:
+            return None
+        key = [path, st.st_mtime, st.st_size, max_width]
+        filename = self.cache.get_filename(key)
+        if filename is not None:
+            return filename
+        if self.failures.get(tuple(key)) is not None:
+            return None
+        size = image_size(path)
+        if size is None or size[0] <= max_width:
+            return None
+        # Rather than holding up the request, which gets the image as is
+        with self.lock:
+            if tuple(key) in self.resizing:
+                return None
+            self.resizing.add(tuple(key))
+        self.pool.submit(self._resize_to_cache, path, key, max_width)
+        return None
+
+    def _resize_to_cache(self, path, key, max_width):
+        try:
+            if self.cache.get_filename(key) is not None:
+                return
+            filename = self._resize(path, max_width)
+            if filename is None:
+                self.failures.set(tuple(key), True)
+                return
+            filename = self.cache.set_file(key, filename)
+            if filename is not None:
+                STAT_CACHE.invalidate(filename)
+        finally:
+            with self.lock:
+                self.resizing.discard(tuple(key))
+
+    def _resize(self, path, width):
+        ext = os.path.splitext(path)[1]
+        try:
+            if not os.path.isdir(self.cache.path):
+                os.makedirs(self.cache.path)
+            fd, tmp_filename = tempfile.mkstemp(suffix=ext, dir=self.cache.path)
+            os.close(fd)
+        except (IOError, OSError):
+            log.exception('Error on creating thumbnail file')
+            return None
+        try:
+            self._resize_file(path, tmp_filename, width)
+            if os.path.getsize(tmp_filename) > 0:
+                return tmp_filename
+        except Exception as err:
+            log.error('Unable to resize image %s: %s', path, err)
+        os.remove(tmp_filename)
+        return None
+
+    def _resize_file(self, path, output, width):
+        try:
+            from PIL import Image
+        except ImportError:
+            self._run_command(path, output, width)
+            return
+        try:
+            image = Image.open(path)
+            # ANTIALIAS is gone since Pillow 10, LANCZOS is the same filter
+            image.thumbnail((width, image.size[1]),
+                            getattr(Image, 'LANCZOS', Image.ANTIALIAS))
+            image.save(output, format=image.format)
+        except Exception as err:
+            # Formats, or modes, PIL can't handle
+            if not self.command:
+                raise
+            log.info('PIL unable to resize image %s (%s), running %s',
+                     path, err, self.command[0])
+            self._run_command(path, output, width)
+
+    def _run_command(self, path, output, width):
+        if not self.command:
+            raise RuntimeError('No image converter available, see "image_proxy_command"')
+        args = [arg.format(input=path, output=output, width=width) for arg in self.command]
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, startupinfo=get_startupinfo())
+        _, errdata = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError('%s exited with %d: %s' % (args[0], proc.returncode,
+                                                          errdata.decode('utf-8', 'replace')))
@@ -0,0 +1,263 @@
+"""
+Copyright (c) 2013 Timon Wong
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from . import log
+
+
+if hasattr(os, 'replace'):
+    replace_file = os.replace
+else:
+    def replace_file(src, dst):
+        # os.rename() won't overwrite an existing file on Windows
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def options_fingerprint(*options):
+    """Fingerprint of (JSON serializable) renderer options"""
+    return text_digest(json.dumps(options, sort_keys=True, default=repr))
+
+
+class LRUCache(object):
+    """Thread safe LRU cache, bounded by the total size of its values.
+
+    Size of a value is measured by `sizeof` (`len` by default), entries larger
+    than the whole cache are never stored. A `max_bytes` of 0 disables caching.
+    """
+
+    # Indexes of a link: [prev, next, key, value, size]
+    PREV, NEXT, KEY, VALUE, SIZE = 0, 1, 2, 3, 4
+
+    def __init__(self, max_bytes=0, sizeof=len):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._clear()
+
+    def _clear(self):
+        self.size = 0
+        self.map = {}
+        # Circular doubly linked list, root.NEXT is the least recently used
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0]
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def _append(self, link):
+        last = self.root[self.PREV]
+        link[self.PREV] = last
+        link[self.NEXT] = self.root
+        last[self.NEXT] = link
+        self.root[self.PREV] = link
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.map:
+            link = self.root[self.NEXT]
+            self._unlink(link)
+            del self.map[link[self.KEY]]
+            self.size -= link[self.SIZE]
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self.map.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[self.VALUE]
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            link = self.map.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+                self.size -= link[self.SIZE]
+            if size > self.max_bytes:
+                return
+            link = [None, None, key, value, size]
+            self._append(link)
+            self.map[key] = link
+            self.size += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.map),
+                'size': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class DiskCache(object):
+    """Persistent cache of text values, stored as one file per key.
+
+    Values are written atomically (to a temporary file renamed into place), so
+    a crash never leaves a truncated entry behind. Once the total size exceeds
+    `max_bytes`, least recently used files are removed. A `max_bytes` of 0
+    disables the cache.
+    """
+
+    SUFFIX = '.html'
+
+    def __init__(self, path=None, max_bytes=0):
+        self.lock = threading.Lock()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = None  # Unknown until the directory is scanned
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.path is not None and self.max_bytes > 0
+
+    def configure(self, path, max_bytes):
+        with self.lock:
+            if path != self.path:
+                self.size = None
+            self.path = path
+            self.max_bytes = max_bytes
+
+    def _filename(self, key):
+        digest = text_digest(json.dumps(key, sort_keys=True))
+        return os.path.join(self.path, digest[:2], digest + self.SUFFIX)
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                value = f.read().decode('utf-8')
+            # Modification time is used as the access time for eviction, atime
+            # is not reliable (noatime, relatime)
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        filename = self._filename(key)
+        dirname = os.path.dirname(filename)
+        data = value.encode('utf-8')
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp_filename = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                old_size = 0
+                if os.path.exists(filename):
+                    old_size = os.path.getsize(filename)
+                replace_file(tmp_filename, filename)
+            except:
+                os.remove(tmp_filename)
+                raise
+        except (IOError, OSError):
+            log.exception('Error on writing render cache file: %s', filename)
+            return
+        with self.lock:
+            if self.size is not None:
+                self.size += len(data) - old_size
+        self._evict()
+
+    def _scan(self):
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                if not filename.endswith(self.SUFFIX):
+                    continue
+                filename = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, filename))
+        return files
+
+    def _evict(self):
+        with self.lock:
+            if self.size is not None and self.size <= self.max_bytes:
+                return
+            files = self._scan()
+            self.size = sum(size for _, size, _ in files)
+            if self.size <= self.max_bytes:
+                return
+            # Evict down to 3/4 of the limit, to avoid scanning on every write
+            target = self.max_bytes * 3 // 4
+            files.sort()
+            for mtime, size, filename in files:
+                if self.size <= target:
+                    break
+                try:
+                    os.remove(filename)
+                    self.size -= size
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self.lock:
+            if self.path is None:
+                return
+            for mtime, size, filename in self._scan():
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            self.size = 0
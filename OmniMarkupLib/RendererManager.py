@@ -23,8 +23,10 @@ SOFTWARE.
 import sublime
 
 import base64
+import hashlib
 import imp
 import inspect
+import json
 import mimetypes
 import os
 import re
@@ -35,10 +37,14 @@ from time import time
 
 from . import log, LibraryPathManager
 from .Setting import Setting
-from .Common import entities_unescape, Singleton, RWLock, Future, PY3K
+from .Common import (entities_unescape, split_html_blocks, Singleton, RWLock, Future,
+                     ThreadPool, PY3K)
+from .RenderCache import DiskCache, LRUCache, options_fingerprint, text_digest, replace_file
 
 # HACK: Make sure required Renderers package load first
 exec('from .Renderers import base_renderer')
+from .Renderers.base_renderer import CancelToken, RenderCancelled, WorkerError, WorkerTimeout
+from .RendererProcessPool import RendererProcessPool
 
 if PY3K:
     from urllib.request import url2pathname
@@ -131,17 +137,49 @@ class RenderedMarkupCacheEntry(dict):
         self['dirname'] = dirname
         self['timestamp'] = str(time())
         self['html_part'] = html_part
+        self['blocks'] = self.make_blocks(html_part)
         self['__deepcopy__'] = self.__deepcopy__
 
+    @staticmethod
+    def make_blocks(html_part):
+        """Split `html_part` into (block_id, html) pairs of top-level elements.
+
+        Block ids are derived from the content, so unchanged blocks keep their
+        ids across versions. Returns None if `html_part` can't be split.
+        """
+        html_blocks = split_html_blocks(html_part)
+        if html_blocks is None:
+            return None
+        blocks = []
+        seen = {}
+        for html in html_blocks:
+            block_id = hashlib.sha1(html.encode('utf-8')).hexdigest()[:16]
+            count = seen.get(block_id, 0)
+            seen[block_id] = count + 1
+            if count:
+                block_id = '%s-%d' % (block_id, count)
+            blocks.append((block_id, html))
+        return blocks
+
     def __deepcopy__(self, memo={}):
         return self.copy()
 
 
 @Singleton
 class RenderedMarkupCache(object):
+    # Number of replaced entries kept per buffer
+    HISTORY_SIZE = 4
+
     def __init__(self):
         self.rwlock = RWLock()
         self.cache = {}
+        # buffer_id -> previous entries, most recent first
+        self.history = {}
+        # Notified on every change, for long polling clients
+        self.cond = threading.Condition()
+        self.wakeups = 0
+        # Called on every change as well, from any thread
+        self.listeners = []
 
     def exists(self, buffer_id):
         with self.rwlock.readlock:
@@ -153,22 +191,91 @@ class RenderedMarkupCache(object):
                 return self.cache[buffer_id]
         return None
 
+    def get_entry_version(self, buffer_id, timestamp):
+        """Get the current or a recently replaced entry with `timestamp`."""
+        with self.rwlock.readlock:
+            entries = [self.cache.get(buffer_id)] + self.history.get(buffer_id, [])
+        for entry in entries:
+            if entry is not None and entry.timestamp == timestamp:
+                return entry
+        return None
+
     def set_entry(self, buffer_id, entry):
         with self.rwlock.writelock:
+            old_entry = self.cache.get(buffer_id)
+            if old_entry is not None:
+                history = [old_entry] + self.history.get(buffer_id, [])
+                self.history[buffer_id] = history[:self.HISTORY_SIZE]
             self.cache[buffer_id] = entry
+        self._notify()
+
+    def disconnect(self, buffer_id):
+        entry = self.get_entry(buffer_id)
+        if entry is not None:
+            entry.disconnected = True
+            self._notify()
 
     def clean(self):
         with self.rwlock.writelock:
             self.cache.clear()
+            self.history.clear()
+        self._notify()
+
+    def add_listener(self, listener):
+        with self.cond:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.cond:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def _notify(self):
+        with self.cond:
+            self.cond.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def wake_all(self):
+        """Make all threads blocked in wait_entry() return (e.g. on shutdown)."""
+        with self.cond:
+            self.wakeups += 1
+            self.cond.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def wait_entry(self, buffer_id, timestamp, timeout):
+        """Wait until the entry of `buffer_id` differs from `timestamp`.
+
+        Returns the entry (None if not found) when it changes, when it gets
+        disconnected, or after `timeout` seconds (or wake_all()) at the latest,
+        so callers must not assume the entry changed.
+        """
+        deadline = time() + timeout
+        with self.cond:
+            wakeups = self.wakeups
+            while True:
+                entry = self.get_entry(buffer_id)
+                if entry is None or entry.disconnected or entry.timestamp != timestamp:
+                    return entry
+                remaining = deadline - time()
+                if remaining <= 0 or self.wakeups != wakeups:
+                    return entry
+                self.cond.wait(remaining)
 
 
 class WorkerQueueItem(object):
-    def __init__(self, buffer_id, timestamp=0, fullpath='untitled', lang='', text=''):
+    def __init__(self, buffer_id, timestamp=0, fullpath='untitled', lang='', text='',
+                 generation=0):
         self.buffer_id = buffer_id
         self.timestamp = timestamp
         self.fullpath = fullpath or 'untitled'
         self.lang = lang
         self.text = text
+        self.generation = generation
+        self.cancel_token = CancelToken()
 
     def __cmp__(self, other):
         return self.buffer_id == other.buffer_id
@@ -177,58 +284,149 @@ class WorkerQueueItem(object):
         return hash(self.buffer_id)
 
 
-class RendererWorker(threading.Thread):
-    def __init__(self, mutex):
-        threading.Thread.__init__(self)
+class RendererWorkerPool(object):
+    """Renders queued buffers on a pool of worker threads.
+
+    There is at most one render in flight per buffer. Text enqueued for a
+    buffer while it's being rendered (or still waiting) replaces the pending
+    item, and each item carries a generation number, so a result is never
+    stored over the result of a newer one. The in flight render of a buffer is
+    cancelled as soon as newer text is enqueued for it.
+    """
+
+    def __init__(self, mutex, num_workers=2):
         self.cond = threading.Condition(mutex)
-        self.que = set()
+        self.num_workers = num_workers
+        self.threads = []
+        self.pending = {}
+        self.pending_order = []
+        # buffer_id -> WorkerQueueItem being rendered by a worker thread
+        self.in_flight = {}
+        # Increasing across buffers, so that generations of a buffer keep
+        # increasing after its entries below are pruned
+        self.generation = 0
+        # buffer_id -> latest generation enqueued, until its result is stored
+        self.generations = {}
+        # buffer_id -> generation stored, while a newer one is yet to be
+        self.stored_generations = {}
         self.stopping = False
 
     def enqueue(self, buffer_id, fullpath, lang, text, immediate=False):
-        item = WorkerQueueItem(buffer_id, fullpath=fullpath, lang=lang, text=text)
-        if immediate:  # Render in the main thread
-            self._run_queued_item(item)
-        else:
-            with self.cond:
-                self.que.add(item)
+        with self.cond:
+            self.generation += 1
+            self.generations[buffer_id] = self.generation
+            item = WorkerQueueItem(buffer_id, fullpath=fullpath, lang=lang, text=text,
+                                   generation=self.generation)
+            if buffer_id in self.in_flight:
+                # Its result would be dropped anyway
+                self.in_flight[buffer_id].cancel_token.cancel()
+            if not immediate:
+                if buffer_id not in self.pending:
+                    self.pending_order.append(buffer_id)
+                self.pending[buffer_id] = item
                 self.cond.notify()
+                return
+        # Render in the main thread
+        self._run_queued_item(item)
 
     def _run_queued_item(self, item):
         try:
             # Render text and save to cache
-            html_part = RendererManager.render_text(item.fullpath, item.lang, item.text)
+            html_part = RendererManager.render_text(item.fullpath, item.lang, item.text,
+                                                    cancel_token=item.cancel_token)
             entry = RenderedMarkupCacheEntry(item.fullpath, html_part=html_part)
-            RenderedMarkupCache.instance().set_entry(item.buffer_id, entry)
-        except NotImplementedError:
+            with self.cond:
+                latest = self.generations.get(item.buffer_id)
+                if (latest is None or
+                        item.generation <= self.stored_generations.get(item.buffer_id, 0)):
+                    # A newer version has been stored already
+                    return
+                RenderedMarkupCache.instance().set_entry(item.buffer_id, entry)
+                if item.generation == latest:
+                    # Nothing newer to wait for
+                    del self.generations[item.buffer_id]
+                    self.stored_generations.pop(item.buffer_id, None)
+                else:
+                    self.stored_generations[item.buffer_id] = item.generation
+        except (NotImplementedError, RenderCancelled):
             pass
         except Exception as err:
             log.exception(err)
 
-    def run(self):
+    def _take_item(self):
+        """Wait for a pending item whose buffer is not being rendered.
+
+        Returns None if the calling thread should exit. Must be called with
+        `self.cond` held.
+        """
+        while True:
+            if self.stopping or len(self.threads) > self.num_workers:
+                return None
+            for buffer_id in self.pending_order:
+                if buffer_id not in self.in_flight:
+                    self.pending_order.remove(buffer_id)
+                    item = self.pending.pop(buffer_id)
+                    self.in_flight[buffer_id] = item
+                    return item
+            self.cond.wait()
+
+    def _worker(self):
         while True:
             with self.cond:
-                self.cond.wait()
-                if self.stopping:
-                    break
-                if len(self.que) == 0:
-                    continue
-            for item in list(self.que):
+                item = self._take_item()
+                if item is None:
+                    self.threads.remove(threading.current_thread())
+                    # Let other threads check whether to exit as well
+                    self.cond.notify_all()
+                    return
+            try:
                 self._run_queued_item(item)
-            self.que.clear()
+            finally:
+                with self.cond:
+                    del self.in_flight[item.buffer_id]
+                    # The buffer may have got newer text meanwhile
+                    self.cond.notify_all()
+
+    def resize(self, num_workers):
+        with self.cond:
+            self.num_workers = max(1, num_workers)
+            if self.stopping:
+                return
+            while len(self.threads) < self.num_workers:
+                thread = threading.Thread(target=self._worker)
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+            self.cond.notify_all()
+
+    def start(self):
+        self.stopping = False
+        self.resize(self.num_workers)
 
     def stop(self):
-        self.stopping = True
         with self.cond:
-            self.cond.notify()
-        self.join()
+            self.stopping = True
+            threads = list(self.threads)
+            self.cond.notify_all()
+        for thread in threads:
+            thread.join()
 
 
 class RendererManager(object):
     MUTEX = threading.Lock()
-    WORKER = RendererWorker(MUTEX)
+    WORKER_POOL = RendererWorkerPool(MUTEX)
 
     LANG_RE = re.compile(r'^[^\s]+(?=\s+)')
     RENDERERS = []
+    # Rendered (and post processed) HTML for previewing
+    RENDER_CACHE = LRUCache()
+    # Survives restarts, mostly useful for slow (commandline) renderers
+    DISK_CACHE = DiskCache()
+    DISK_CACHE_DIR = None
+    RENDERER_FINGERPRINTS = {}
+    PROCESS_POOL = RendererProcessPool()
+    # Global settings used by renderers running in PROCESS_POOL
+    PROCESS_POOL_GLOBAL_SETTING = {}
 
     @classmethod
     def any_available_renderer(cls, filename, lang):
@@ -255,20 +453,151 @@ class RendererManager(object):
         return lang
 
     @classmethod
-    def render_text(cls, fullpath, lang, text, post_process_func=None):
-        """Render text (markups) as HTML"""
+    def render_text(cls, fullpath, lang, text, post_process_func=None, cancel_token=None):
+        """Render text (markups) as HTML
+
+        Raises RenderCancelled if `cancel_token` gets cancelled meanwhile.
+        """
+        # Only results for previewing are cached, exporting embeds images, which
+        # may change without the text changing. So may included files, see
+        # reads_other_files().
+        cacheable = post_process_func is None
         if post_process_func is None:
             post_process_func = cls.render_text_postprocess
         filename = os.path.basename(fullpath)
         for renderer_classname, renderer in cls.RENDERERS:
             try:
                 if renderer.is_enabled(filename, lang):
-                    rendered_text = renderer.render(text, filename=filename)
-                    return post_process_func(rendered_text, fullpath)
+                    cacheable = cacheable and not renderer.reads_other_files(text)
+                    if cacheable:
+                        cache_key = (renderer_classname,
+                                     cls.RENDERER_FINGERPRINTS.get(renderer_classname),
+                                     text_digest(text),
+                                     os.path.dirname(fullpath))
+                        html_part = cls.RENDER_CACHE.get(cache_key)
+                        if html_part is not None:
+                            return html_part
+                        html_part = cls.DISK_CACHE.get(cache_key)
+                        if html_part is not None:
+                            cls.RENDER_CACHE.set(cache_key, html_part)
+                            return html_part
+                    rendered_text = cls._render(renderer_classname, renderer, text, fullpath,
+                                                cancel_token)
+                    html_part = post_process_func(rendered_text, fullpath)
+                    # Failed renders raise, yet an empty result may be a
+                    # failure as well, don't keep serving it
+                    if cacheable and html_part:
+                        cls.RENDER_CACHE.set(cache_key, html_part)
+                        cls.DISK_CACHE.set(cache_key, html_part)
+                    return html_part
+            except RenderCancelled:
+                raise
             except:
                 log.exception('Exception occured while rendering using %s', renderer_classname)
         raise NotImplementedError()
 
+    @classmethod
+    def _render(cls, renderer_classname, renderer, text, fullpath, cancel_token=None):
+        filename = os.path.basename(fullpath)
+        from .Renderers import pygments_cache
+        if cls.PROCESS_POOL.handles(renderer_classname):
+            try:
+                html, aliases = cls.PROCESS_POOL.render(
+                    renderer_classname, renderer, text, fullpath,
+                    cls.PROCESS_POOL_GLOBAL_SETTING, cancel_token)
+                cls.record_recent_lexers(aliases)
+                return html
+            except WorkerTimeout:
+                raise
+            except WorkerError as err:
+                log.error('Renderer process unavailable (%s), rendering in process instead', err)
+        try:
+            return renderer.render(text, filename=filename, fullpath=fullpath,
+                                   cancel_token=cancel_token)
+        finally:
+            cls.record_recent_lexers(pygments_cache.used_aliases)
+
+    # Pygments lexers used by recent documents, loaded in background on start,
+    # so the first render after a restart doesn't stall on their imports.
+    RECENT_LEXERS_FILE = None
+    RECENT_LEXERS_MAX = 16
+    RECENT_LEXERS = []
+    RECENT_LEXERS_LOCK = threading.Lock()
+    # Changes are saved this many seconds later (or upon stop()), off the
+    # rendering threads
+    RECENT_LEXERS_SAVE_DELAY = 30
+    RECENT_LEXERS_SAVE_TIMER = None
+    RECENT_LEXERS_DIRTY = False
+
+    @classmethod
+    def load_recent_lexers(cls):
+        try:
+            with open(cls.RECENT_LEXERS_FILE, 'r') as f:
+                aliases = json.load(f)
+        except (IOError, OSError, ValueError):
+            return []
+        if not isinstance(aliases, list):
+            return []
+        return aliases
+
+    @classmethod
+    def record_recent_lexers(cls, aliases):
+        """Move `aliases` (in order of first use) to the front of RECENT_LEXERS.
+
+        The list is saved later on, if it changed.
+        """
+        used_aliases = list(reversed(aliases))
+        with cls.RECENT_LEXERS_LOCK:
+            recent = used_aliases + [alias for alias in cls.RECENT_LEXERS
+                                     if alias not in used_aliases]
+            recent = recent[:cls.RECENT_LEXERS_MAX]
+            if recent == cls.RECENT_LEXERS:
+                return
+            cls.RECENT_LEXERS = recent
+            cls.RECENT_LEXERS_DIRTY = True
+            if cls.RECENT_LEXERS_SAVE_TIMER is None:
+                timer = threading.Timer(cls.RECENT_LEXERS_SAVE_DELAY, cls.save_recent_lexers)
+                timer.daemon = True
+                cls.RECENT_LEXERS_SAVE_TIMER = timer
+                timer.start()
+
+    @classmethod
+    def save_recent_lexers(cls):
+        with cls.RECENT_LEXERS_LOCK:
+            if cls.RECENT_LEXERS_SAVE_TIMER is not None:
+                cls.RECENT_LEXERS_SAVE_TIMER.cancel()
+                cls.RECENT_LEXERS_SAVE_TIMER = None
+            if not cls.RECENT_LEXERS_DIRTY or cls.RECENT_LEXERS_FILE is None:
+                return
+            cls.RECENT_LEXERS_DIRTY = False
+            recent = cls.RECENT_LEXERS
+            tmp_filename = cls.RECENT_LEXERS_FILE + '.tmp'
+            try:
+                dirname = os.path.dirname(cls.RECENT_LEXERS_FILE)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                with open(tmp_filename, 'w') as f:
+                    json.dump(recent, f)
+                replace_file(tmp_filename, cls.RECENT_LEXERS_FILE)
+            except (IOError, OSError):
+                log.exception('Error on writing recent lexers: %s', cls.RECENT_LEXERS_FILE)
+
+    @classmethod
+    def warm_up_lexers(cls):
+        def _warm_up():
+            from .Renderers import pygments_cache
+            start = time()
+            timings = pygments_cache.warm_up(list(cls.RECENT_LEXERS))
+            if timings:
+                log.info('Loaded %d recently used lexers in %.0fms: %s', len(timings),
+                         (time() - start) * 1000,
+                         ', '.join('%s (%.0fms)' % (alias, seconds * 1000)
+                                   for alias, seconds in timings))
+
+        thread = threading.Thread(target=_warm_up)
+        thread.daemon = True
+        thread.start()
+
     IMG_TAG_RE = re.compile(r'(<img [^>]*src=")([^"]+)("[^>]*>)', re.DOTALL | re.IGNORECASE | re.MULTILINE)
 
     @classmethod
@@ -294,43 +623,158 @@ class RendererManager(object):
     @classmethod
     def render_text_postprocess_exporting(cls, rendered_text, filename):
         # Embedding images
-        dirname = os.path.dirname(filename)
+        segments = cls.render_text_postprocess_segments(rendered_text, filename)
+        return ''.join(cls.iter_segments(segments))
 
-        def encode_image_path(m):
+    @classmethod
+    def render_text_postprocess_segments(cls, rendered_text, filename):
+        """Split rendered text around local images to be embedded.
+
+        Returns a list of text, and of (mime_type, local_path) for images, whose
+        data URIs are only produced by iter_segments().
+        """
+        dirname = os.path.dirname(filename)
+        segments = []
+        pos = 0
+        for m in cls.IMG_TAG_RE.finditer(rendered_text):
             url = m.group(2)
             o = urlparse(url)
             if (len(o.scheme) > 0 and o.scheme != 'file') or url.startswith('//'):
-                # Is a valid url, returns original text
-                return m.group(0)
+                # Is a valid url, keeps original text
+                continue
             # or local file (maybe?)
             if o.scheme == 'file':
                 local_path = file_uri_to_path(url)
             else:
                 local_path = os.path.normpath(os.path.join(dirname, entities_unescape(url)))
+            segments.append(rendered_text[pos:m.end(1)])
             mime_type, _ = mimetypes.guess_type(os.path.basename(local_path))
             if mime_type is not None:
-                data_uri = base64.b64encode(open(local_path, 'rb').read())
-                image_tag_src = 'data:%s;base64,%s' % (mime_type, data_uri.decode('ascii'))
+                segments.append((mime_type, local_path))
             else:
-                image_tag_src = '[Invalid mime type]'
-            return m.group(1) + image_tag_src + m.group(3)
+                segments.append('[Invalid mime type]')
+            pos = m.start(3)
+        segments.append(rendered_text[pos:])
+        return segments
+
+    # Base64 encoded images, keyed by (path, mtime, size), so images repeated
+    # in a document, or across exports, are only read and encoded once
+    EMBEDDED_IMAGES_CACHE = LRUCache(16 * 1024 * 1024)
+    # Larger images are streamed when exporting to files, and never cached
+    EMBEDDED_IMAGE_MAX_CACHED_SIZE = 1024 * 1024
+    EMBEDDED_IMAGE_POOL = ThreadPool(4)
+    # Distinct images submitted to EMBEDDED_IMAGE_POOL ahead of the one being
+    # embedded
+    EMBEDDED_IMAGE_PREFETCH = 4
 
-        return cls.IMG_TAG_RE.sub(encode_image_path, rendered_text)
+    @classmethod
+    def encode_image(cls, local_path, max_size=None):
+        st = os.stat(local_path)
+        if max_size is not None and st.st_size > max_size:
+            return None
+        key = (local_path, st.st_mtime, st.st_size)
+        data = cls.EMBEDDED_IMAGES_CACHE.get(key)
+        if data is None:
+            with open(local_path, 'rb') as f:
+                data = base64.b64encode(f.read()).decode('ascii')
+            cls.EMBEDDED_IMAGES_CACHE.set(key, data)
+        return data
+
+    # Multiple of 3, so chunks encode to base64 without padding
+    EXPORT_IMAGE_CHUNK_SIZE = 3 * 64 * 1024
+
+    @classmethod
+    def iter_segments(cls, segments, max_size=None):
+        """Yield text of segments, with images as base64 data URIs.
+
+        Each distinct image is encoded once, on EMBEDDED_IMAGE_POOL, up to
+        EMBEDDED_IMAGE_PREFETCH images ahead of the one being yielded, and held
+        until its last occurrence is yielded. Images larger than `max_size` are
+        read and encoded a chunk at a time instead.
+        """
+        # Distinct images in order of appearance, and where they last appear
+        paths = []
+        ranks = {}
+        last_indexes = {}
+        for index, segment in enumerate(segments):
+            if isinstance(segment, tuple):
+                if segment[1] not in ranks:
+                    ranks[segment[1]] = len(paths)
+                    paths.append(segment[1])
+                last_indexes[segment[1]] = index
+        futures = {}
+        submitted = 0
+        for index, segment in enumerate(segments):
+            if not isinstance(segment, tuple):
+                yield segment
+                continue
+            mime_type, local_path = segment
+            ahead = min(len(paths), ranks[local_path] + cls.EMBEDDED_IMAGE_PREFETCH)
+            while submitted < ahead:
+                futures[paths[submitted]] = cls.EMBEDDED_IMAGE_POOL.submit(
+                    cls.encode_image, paths[submitted], max_size)
+                submitted += 1
+            if last_indexes[local_path] == index:
+                data = futures.pop(local_path).result()
+            else:
+                data = futures[local_path].result()
+            if data is not None:
+                yield 'data:%s;base64,%s' % (mime_type, data)
+                data = None
+                continue
+            with open(local_path, 'rb') as f:
+                yield 'data:%s;base64,' % mime_type
+                while True:
+                    data = f.read(cls.EXPORT_IMAGE_CHUNK_SIZE)
+                    if not data:
+                        break
+                    yield base64.b64encode(data).decode('ascii')
 
     @classmethod
     def render_view_as_html(cls, view):
+        return ''.join(cls.render_view_as_html_chunks(view, stream_images=False))
+
+    # Stands for the rendered content in exported pages, which are split around it
+    EXPORT_HTML_PART_MARKER = '<!--OmniMarkupPreviewer:html_part-->'
+
+    @classmethod
+    def render_view_as_html_chunks(cls, view, stream_images=True):
+        """Render view as a complete HTML page, in chunks.
+
+        The markup is rendered right away, while the page is only produced
+        when iterating over the result, embedding a few images at a time. With
+        `stream_images`, large images are read and encoded a chunk at a time,
+        so exporting needs little memory whatever the images sizes are.
+        """
         fullpath = view.file_name() or ''
         lang = RendererManager.get_lang_by_scope_name(view.scope_name(0))
         text = view.substr(sublime.Region(0, view.size()))
-        html_part = RendererManager.render_text(
+        segments = RendererManager.render_text(
             fullpath, lang, text,
-            post_process_func=cls.render_text_postprocess_exporting)
+            post_process_func=cls.render_text_postprocess_segments)
+        max_size = cls.EMBEDDED_IMAGE_MAX_CACHED_SIZE if stream_images else None
         setting = Setting.instance()
-        return template(setting.export_options['template_name'],
-                        mathjax_enabled=setting.mathjax_enabled,
-                        filename=os.path.basename(fullpath),
-                        dirname=os.path.dirname(fullpath),
-                        html_part=html_part)
+
+        def render_template(html_part):
+            return template(setting.export_options['template_name'],
+                            mathjax_enabled=setting.mathjax_enabled,
+                            filename=os.path.basename(fullpath),
+                            dirname=os.path.dirname(fullpath),
+                            html_part=html_part)
+
+        def iter_chunks():
+            page = render_template(cls.EXPORT_HTML_PART_MARKER)
+            if page.count(cls.EXPORT_HTML_PART_MARKER) != 1:
+                # html_part is escaped or repeated by the template
+                yield render_template(''.join(cls.iter_segments(segments, max_size)))
+                return
+            head, tail = page.split(cls.EXPORT_HTML_PART_MARKER)
+            yield head
+            for chunk in cls.iter_segments(segments, max_size):
+                yield chunk
+            yield tail
+
+        return iter_chunks()
 
     @classmethod
     def enqueue_view(cls, view, only_exists=False, immediate=False):
@@ -340,7 +784,7 @@ class RendererManager(object):
         region = sublime.Region(0, view.size())
         text = view.substr(region)
         lang = cls.get_lang_by_scope_name(view.scope_name(0))
-        cls.WORKER.enqueue(buffer_id, view.file_name(), lang, text, immediate=immediate)
+        cls.WORKER_POOL.enqueue(buffer_id, view.file_name(), lang, text, immediate=immediate)
 
     @classmethod
     def enqueue_buffer_id(cls, buffer_id, only_exists=False, immediate=False):
@@ -433,7 +877,16 @@ class RendererManager(object):
             finally:
                 # Restore the current directory
                 os.chdir(oldpath)
-        cls.RENDERERS = renderers
+        old_renderers, cls.RENDERERS = cls.RENDERERS, renderers
+        cls.shutdown_renderers(old_renderers)
+
+    @classmethod
+    def shutdown_renderers(cls, renderers):
+        for renderer_classname, renderer in renderers:
+            try:
+                renderer.shutdown()
+            except:
+                log.exception('Error on shutting down renderer: %s', renderer_classname)
 
     OLD_IGNORED_RENDERERS = set()
 
@@ -448,13 +901,33 @@ class RendererManager(object):
             # Reload renderers, of course
             cls.load_renderers(setting.ignored_renderers)
 
+        fingerprints = {}
         for renderer_classname, renderer in cls.RENDERERS:
             key = 'renderer_options-' + renderer_classname
             try:
                 renderer_options = setting.get_setting(key, {})
                 renderer.load_settings(renderer_options, setting)
+                fingerprints[renderer_classname] = options_fingerprint(
+                    renderer_options, setting.mathjax_enabled)
             except:
                 log.exception('Error on setting renderer options for %s', renderer_classname)
+        cls.RENDERER_FINGERPRINTS = fingerprints
+        cls.RENDER_CACHE.clear()
+        cls.RENDER_CACHE.resize(setting.render_cache_max_bytes)
+        disk_cache_max_bytes = 0
+        if setting.render_disk_cache_enabled:
+            disk_cache_max_bytes = setting.render_disk_cache_max_bytes
+        cls.DISK_CACHE.configure(cls.DISK_CACHE_DIR, disk_cache_max_bytes)
+        cls.WORKER_POOL.resize(setting.render_workers)
+
+        out_of_process_renderers = [renderer_classname
+                                    for renderer_classname, renderer in cls.RENDERERS
+                                    if renderer.OUT_OF_PROCESS]
+        cls.PROCESS_POOL_GLOBAL_SETTING = {'mathjax_enabled': setting.mathjax_enabled}
+        cls.PROCESS_POOL.configure(setting.renderer_process_python,
+                                   setting.renderer_processes,
+                                   out_of_process_renderers,
+                                   request_timeout=setting.persistent_worker_request_timeout)
 
     WAIT_TIMEOUT = 1.0
     STARTED = True
@@ -472,21 +945,28 @@ class RendererManager(object):
     @classmethod
     def start(cls):
         cls.STARTED = False
+        cls.DISK_CACHE_DIR = os.path.normpath(os.path.join(
+            sublime.packages_path(), 'User', 'OmniMarkupPreviewer', 'cache', 'render'))
+        cls.RECENT_LEXERS_FILE = os.path.normpath(os.path.join(
+            sublime.packages_path(), 'User', 'OmniMarkupPreviewer', 'cache', 'lexers.json'))
 
         setting = Setting.instance()
         setting.subscribe('changing', cls.on_setting_changing)
         setting.subscribe('changed', cls.on_setting_changed)
 
-        cls.WORKER.start()
+        cls.WORKER_POOL.start()
         cls.on_setting_changing(setting)
 
         def _start():
+            with cls.RECENT_LEXERS_LOCK:
+                cls.RECENT_LEXERS = cls.load_recent_lexers()
             cls.load_renderers(setting.ignored_renderers)
             f = Future(lambda: cls.on_setting_changed(setting))
             sublime.set_timeout(f, 0)
             f.result()
             cls.RENDERERS_LOADER_THREAD = None
             cls.STARTED = True
+            cls.warm_up_lexers()
 
         cls.RENDERERS_LOADER_THREAD = threading.Thread(target=_start)
         # Postpone renderer loader thread, otherwise break loading of other plugins.
@@ -495,9 +975,12 @@ class RendererManager(object):
     @classmethod
     def stop(cls):
         cls.STARTED = False
-        cls.WORKER.stop()
+        cls.WORKER_POOL.stop()
         if cls.RENDERERS_LOADER_THREAD is not None:
             try:
                 cls.RENDERERS_LOADER_THREAD.join()
             except:
                 pass
+        cls.PROCESS_POOL.shutdown()
+        cls.shutdown_renderers(cls.RENDERERS)
+        cls.save_recent_lexers()
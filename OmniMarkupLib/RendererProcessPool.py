@@ -0,0 +1,122 @@
+"""
+Copyright (c) 2013 Timon Wong
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import json
+import os
+import threading
+
+from . import log
+from .Renderers.base_renderer import PersistentWorker, WorkerError, get_startupinfo
+
+__file__ = os.path.normpath(os.path.abspath(__file__))
+__path__ = os.path.dirname(__file__)
+
+RENDER_WORKER_SCRIPT = os.path.join(__path__, 'Renderers', 'bin', 'render_worker.py')
+
+
+class RendererProcessPool(object):
+    """Runs pure python renderers in warm child python processes.
+
+    Keeps CPU bound renders (Markdown, docutils...) from competing for the GIL
+    with Sublime Text and the preview server. The plugin host can't start
+    copies of itself, so a python interpreter has to be configured.
+
+    Documents are dispatched by filename, so renderers with per document state
+    (like incremental Markdown rendering) keep seeing the same process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executable = None
+        self.renderer_classnames = []
+        self.workers = []
+
+    @property
+    def enabled(self):
+        return len(self.workers) > 0
+
+    def configure(self, executable, num_processes, renderer_classnames,
+                  request_timeout=30):
+        with self.lock:
+            old_workers = self.workers
+            self.workers = []
+            if executable and num_processes > 0 and renderer_classnames:
+                args = [executable, RENDER_WORKER_SCRIPT, '--worker'] + renderer_classnames
+                for i in range(num_processes):
+                    self.workers.append(PersistentWorker(args, startupinfo=get_startupinfo(),
+                                                         request_timeout=request_timeout,
+                                                         idle_timeout=0))
+            self.renderer_classnames = renderer_classnames
+        for worker in old_workers:
+            worker.shutdown()
+
+        # Warm up in background, so the first render doesn't pay for imports
+        def warm_up(workers):
+            for worker in workers:
+                try:
+                    worker.start()
+                except WorkerError as err:
+                    log.error('Unable to start renderer process: %s', err)
+                    break
+
+        workers = self.workers
+        if workers:
+            thread = threading.Thread(target=warm_up, args=(workers,))
+            thread.daemon = True
+            thread.start()
+
+    def handles(self, renderer_classname):
+        return self.enabled and renderer_classname in self.renderer_classnames
+
+    def render(self, renderer_classname, renderer, text, fullpath, global_setting,
+               cancel_token=None):
+        """Render `text` in a child process.
+
+        Returns (html, aliases of the Pygments lexers used by the child process).
+        Raises WorkerError if no child process is available. Cancellation is
+        only checked before and after the request, child processes are too
+        expensive to restart to be killed for it.
+        """
+        with self.lock:
+            workers = self.workers
+        if not workers:
+            raise WorkerError('No renderer process available')
+        worker = workers[hash(fullpath) % len(workers)]
+        request = {
+            'renderer': renderer_classname,
+            'options': renderer.renderer_options,
+            'global_setting': global_setting,
+            'filename': os.path.basename(fullpath),
+            'fullpath': fullpath,
+            'text': text,
+        }
+        data = json.dumps(request).encode('utf-8')
+        if cancel_token is not None:
+            cancel_token.check()
+        response = json.loads(worker.request(data).decode('utf-8'))
+        if cancel_token is not None:
+            cancel_token.check()
+        return response['html'], response['lexers']
+
+    def shutdown(self):
+        self.configure(None, 0, [])
@@ -10,6 +10,7 @@ __path__ = os.path.dirname(__file__)
 class AsciiDocRenderer(CommandlineRenderer):
     def __init__(self):
         super(AsciiDocRenderer, self).__init__(
+            input_method=InputMethod.WORKER,
             executable='ruby',
             args=['-rubygems', os.path.join(__path__, 'bin/asciidoc.rb')])
 
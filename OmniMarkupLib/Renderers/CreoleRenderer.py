@@ -4,6 +4,7 @@ import creoleparser
 
 @renderer
 class CreoleRenderer(MarkupRenderer):
+    OUT_OF_PROCESS = True
     @classmethod
     def is_enabled(cls, filename, syntax):
         if syntax == 'text.html.creole':
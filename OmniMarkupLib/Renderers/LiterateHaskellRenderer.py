@@ -10,6 +10,7 @@ __path__ = os.path.dirname(__file__)
 class LiterateHaskellRenderer(CommandlineRenderer):
     def __init__(self):
         super(LiterateHaskellRenderer, self).__init__(
+            input_method=InputMethod.WORKER,
             executable='ruby',
             args=['-rubygems', os.path.join(__path__, 'bin/lhs2html.rb')])
 
@@ -1,13 +1,209 @@
 from .base_renderer import *
+import hashlib
 import re
+import threading
 import markdown
+from markdown.extensions.fenced_code import FencedBlockPreprocessor
+from markdown.preprocessors import HtmlBlockPreprocessor, ReferencePreprocessor
+from markdown.util import isBlockLevel
+from .pygments_cache import install_markdown, configure_guessing
+
+install_markdown()
+
+
+class MarkdownBlockSplitter(object):
+    """Split markdown source into top-level blocks.
+
+    Blocks are separated by blank lines, but fenced code, indented
+    continuations, lists, blockquotes, definition lists and raw HTML blocks are
+    never split, so each block renders to the same HTML as it would inside the
+    whole document. Reference definitions found outside of fenced code are
+    collected as well (along with abbreviations, when `abbreviations` is set),
+    since they apply document-wide.
+
+    `splittable` is False when the document can't be split safely, and has to
+    be rendered as a whole (e.g. while a code fence is left open).
+    """
+
+    FENCE_RE = re.compile(r'^(~{3,}|`{3,})')
+    # Matching whole fenced code blocks, from the opening line
+    FENCED_BLOCK_RE = FencedBlockPreprocessor.FENCED_BLOCK_RE
+    LIST_ITEM_RE = re.compile(r'^([*+-]|\d+\.)[ \t]')
+    DEFINITION_RE = re.compile(r'^[ ]{0,3}:[ ]{1,3}')
+    REFERENCE_RE = ReferencePreprocessor.RE
+    REFERENCE_TITLE_RE = ReferencePreprocessor.TITLE_RE
+    ABBREVIATION_RE = re.compile(r'^[*]\[[^\]]*\][ ]?:')
+    FOOTNOTE_RE = re.compile(r'^[ ]{0,3}\[\^[^\]]*\]:')
+    # Used for its tag matching only, to tell raw HTML blocks apart exactly
+    # the way markdown does
+    HTML_BLOCK_PROCESSOR = HtmlBlockPreprocessor()
+
+    def __init__(self, text, abbreviations=False):
+        self.abbreviations = abbreviations
+        self.blocks = []
+        self.definitions = []
+        self.splittable = True
+        # Left tag of the raw HTML block markdown is in, if any
+        self.html_tag = None
+        self._split(text)
+
+    def _block_kind(self, lines, i):
+        line = lines[i]
+        if self.LIST_ITEM_RE.match(line):
+            return 'list'
+        if line.startswith('>'):
+            return 'quote'
+        # Definitions are merged into a preceding definition list
+        while i < len(lines) and lines[i].strip():
+            if self.DEFINITION_RE.match(lines[i]):
+                return 'definitions'
+            i += 1
+        return None
+
+    def _scan_html(self, paragraph):
+        """Track raw HTML blocks across a paragraph (text between blank lines).
+
+        Follows `HtmlBlockPreprocessor.run()`, which works on the same
+        paragraphs. Returns True if the paragraph is part of a raw HTML block.
+        """
+        processor = self.HTML_BLOCK_PROCESSOR
+        if self.html_tag is None:
+            if not paragraph.startswith('<') or len(paragraph.strip()) <= 1:
+                return False
+            if paragraph[1:4] == '!--':
+                left_tag, left_index, attrs = '--', 2, {}
+            else:
+                left_tag, left_index, attrs = processor._get_left_tag(paragraph)
+            block_level = isBlockLevel(left_tag) or left_tag == '--'
+            if not (block_level or paragraph[1] in ['!', '?', '@', '%']):
+                return False
+            if processor._is_oneliner(left_tag):
+                return True
+            if 'markdown' in attrs:
+                # Markdown in raw HTML (extra) nests blocks in between
+                self.splittable = False
+                return True
+            right_tag, data_index = processor._get_right_tag(left_tag, left_index, paragraph)
+            if block_level and paragraph[data_index:].strip():
+                # Markdown reads the rest of the paragraph as a new block
+                self.splittable = False
+            elif block_level and not processor._equal_tags(left_tag, right_tag):
+                self.html_tag = left_tag
+            return True
+        right_tag, data_index = processor._get_right_tag(self.html_tag, 0, paragraph)
+        if processor._equal_tags(self.html_tag, right_tag):
+            self.html_tag = None
+            if paragraph[data_index:].strip():
+                self.splittable = False
+        return True
+
+    def _end_paragraph(self, paragraph, definitions):
+        if paragraph and not self._scan_html('\n'.join(paragraph)):
+            self.definitions.extend(definitions)
+
+    def _split(self, text):
+        lines = text.split('\n')
+        offsets = []
+        pos = 0
+        for line in lines:
+            offsets.append(pos)
+            pos += len(line) + 1
+        block = []
+        # Lines of the current paragraph, with fenced code as a placeholder,
+        # and the definitions found in it
+        paragraph = []
+        paragraph_definitions = []
+        kind = None
+        prev_blank = False
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            i += 1
+            if not line.strip():
+                block.append(line)
+                self._end_paragraph(paragraph, paragraph_definitions)
+                paragraph = []
+                paragraph_definitions = []
+                prev_blank = True
+                continue
+            if prev_blank and block and line[0] not in ' \t' and self.html_tag is None:
+                new_kind = self._block_kind(lines, i - 1)
+                if (new_kind is None or new_kind != kind) and not line.startswith(':'):
+                    self.blocks.append('\n'.join(block))
+                    block = []
+            prev_blank = False
+            if not block:
+                kind = self._block_kind(lines, i - 1)
+            elif self.DEFINITION_RE.match(line):
+                kind = 'definitions'
+            block.append(line)
+            if self.FENCE_RE.match(line):
+                m = self.FENCED_BLOCK_RE.match(text, offsets[i - 1])
+                if m is None:
+                    # Not fenced code until it's closed, while the rest of
+                    # the document may or may not read as code
+                    self.splittable = False
+                    return
+                end = i + m.group(0).count('\n')
+                block.extend(lines[i:end])
+                i = end
+                paragraph.append('\x02fenced code\x03')
+                continue
+            paragraph.append(line)
+            if self.FOOTNOTE_RE.match(line):
+                self.splittable = False
+                continue
+            if self.abbreviations and self.ABBREVIATION_RE.match(line):
+                paragraph_definitions.append(line)
+                continue
+            m = self.REFERENCE_RE.match(line)
+            if m:
+                # Exactly as ReferencePreprocessor, the title may be on the next line
+                paragraph_definitions.append(line)
+                if (not (m.group(5) or m.group(6) or m.group(7)) and i < len(lines) and
+                        self.REFERENCE_TITLE_RE.match(lines[i])):
+                    paragraph_definitions.append(lines[i])
+        self._end_paragraph(paragraph, paragraph_definitions)
+        if block:
+            self.blocks.append('\n'.join(block))
+
+
+class CancelCheckpoint(object):
+    """Checks the cancel token of the current render between markdown stages.
+
+    Registered as a preprocessor, treeprocessor and postprocessor, all of
+    which get their input back unchanged.
+    """
+
+    def __init__(self, md):
+        self.markdown = md
+
+    def run(self, data):
+        cancel_token = getattr(self.markdown, 'cancel_token', None)
+        if cancel_token is not None:
+            cancel_token.check()
+        return data
 
 
 @renderer
 class MarkdownRenderer(MarkupRenderer):
+    OUT_OF_PROCESS = True
     FILENAME_PATTERN_RE = re.compile(r'\.(md|mmd|mkdn?|mdwn|mdown|markdown|litcoffee)$')
     YAML_FRONTMATTER_RE = re.compile(r'\A---\s*\n.*?\n?^---\s*$\n?', re.DOTALL | re.MULTILINE)
     MARKDOWN_SYNTAX_RE = re.compile(r'^text\.html\.markdown\S*')
+    # Extensions that need to see the whole document at once
+    NON_INCREMENTAL_EXTENSIONS = ('toc',)
+    ABBREVIATION_EXTENSIONS = ('abbr', 'extra')
+
+    def __init__(self):
+        super(MarkdownRenderer, self).__init__()
+        self.extensions = []
+        # (generation, extensions), the generation is bumped whenever
+        # extensions change, so per-thread engines get rebuilt
+        self.engine_config = (0, self.extensions)
+        self.engines = threading.local()
+        self.incremental = False
+        self.fragments = new_fragments_cache()
 
     def load_settings(self, renderer_options, global_setting):
         super(MarkdownRenderer, self).load_settings(renderer_options, global_setting)
@@ -25,8 +221,15 @@ class MarkdownRenderer(MarkupRenderer):
             extensions.add('smarty')
         if 'codehilite' in extensions:
             extensions.remove('codehilite')
-            extensions.add('codehilite(linenums=False,guess_lang=False)')
-        self.extensions = list(extensions)
+            extensions.add('codehilite(linenums=False,guess_lang=%s)' %
+                           bool(renderer_options.get('guess_language', False)))
+        extensions = sorted(extensions)
+        if extensions != self.extensions:
+            self.extensions = extensions
+            self.engine_config = (self.engine_config[0] + 1, extensions)
+        configure_guessing(renderer_options.get('guess_lexer_timeout', 0))
+        self.incremental = renderer_options.get('incremental', False)
+        self.fragments.clear()
 
     @classmethod
     def is_enabled(cls, filename, syntax):
@@ -44,5 +247,85 @@ class MarkdownRenderer(MarkupRenderer):
 
     def render(self, text, **kwargs):
         text = self.YAML_FRONTMATTER_RE.sub('', text)
-        return markdown.markdown(text, output_format='html5',
-                                 extensions=self.extensions)
+        if self.incremental and self.incremental_capable():
+            fullpath = kwargs.get('fullpath', kwargs.get('filename', ''))
+            result = self.render_incremental(text, fullpath, kwargs.get('cancel_token'))
+            if result is not None:
+                return result
+        check_cancelled(kwargs)
+        return self.render_markdown(text, kwargs.get('cancel_token'))
+
+    def get_engine(self):
+        """Get the `Markdown` instance owned by the calling thread.
+
+        Building a `Markdown` instance loads every extension and populates all
+        of the processor registries, so it's only done once per thread, and
+        again after the extension list changes.
+        """
+        engines = self.engines
+        generation, extensions = self.engine_config
+        if getattr(engines, 'generation', None) != generation:
+            md = markdown.Markdown(output_format='html5', extensions=extensions)
+            checkpoint = CancelCheckpoint(md)
+            # After preprocessors, after parsing, and after treeprocessors
+            md.preprocessors.add('cancel_checkpoint', checkpoint, '_end')
+            md.treeprocessors.add('cancel_checkpoint', checkpoint, '_begin')
+            md.postprocessors.add('cancel_checkpoint', checkpoint, '_begin')
+            engines.md = md
+            engines.generation = generation
+        return engines.md
+
+    def render_markdown(self, text, cancel_token=None):
+        md = self.get_engine()
+        md.reset()
+        md.cancel_token = cancel_token
+        # The abbr extension registers a pattern per abbreviation and never
+        # removes them, don't let them leak into the next document.
+        for key in list(md.inlinePatterns.keys()):
+            if key.startswith('abbr-'):
+                del md.inlinePatterns[key]
+        return md.convert(text)
+
+    def incremental_capable(self):
+        for extension in self.extensions:
+            if extension.split('(')[0] in self.NON_INCREMENTAL_EXTENSIONS:
+                return False
+        return True
+
+    def render_incremental(self, text, fullpath, cancel_token=None):
+        """Render only blocks changed since the last render of `fullpath`.
+
+        Returns None if the document can't be rendered block by block.
+        """
+        abbreviations = False
+        for extension in self.extensions:
+            if extension.split('(')[0] in self.ABBREVIATION_EXTENSIONS:
+                abbreviations = True
+        splitter = MarkdownBlockSplitter(text, abbreviations=abbreviations)
+        if not splitter.splittable:
+            return None
+        # Reference definitions are appended to every block, so links in
+        # unchanged blocks stay correct, and editing a definition invalidates
+        # all blocks at once.
+        definitions = '\n'.join(splitter.definitions)
+        old_fragments = self.fragments.get(fullpath, {})
+        fragments = {}
+        html_parts = []
+        for block in splitter.blocks:
+            source = block
+            if definitions:
+                source = block + '\n\n' + definitions
+            digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+            if digest in fragments:
+                html = fragments[digest]
+            elif digest in old_fragments:
+                html = old_fragments[digest]
+            else:
+                if cancel_token is not None:
+                    cancel_token.check()
+                html = self.render_markdown(source, cancel_token)
+            fragments[digest] = html
+            if html:
+                html_parts.append(html)
+        self.fragments.set(fullpath, fragments)
+        return '\n'.join(html_parts)
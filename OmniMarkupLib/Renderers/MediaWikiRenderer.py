@@ -10,6 +10,7 @@ __path__ = os.path.dirname(__file__)
 class MediaWikiRenderer(CommandlineRenderer):
     def __init__(self):
         super(MediaWikiRenderer, self).__init__(
+            input_method=InputMethod.WORKER,
             executable='ruby',
             args=['-rubygems', os.path.join(__path__, 'bin/mw2html.rb')])
 
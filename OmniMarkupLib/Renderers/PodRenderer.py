@@ -1,14 +1,24 @@
 from .base_renderer import *
+import os.path
 import re
 
 
+__file__ = os.path.normpath(os.path.abspath(__file__))
+__path__ = os.path.dirname(__file__)
+
+
 @renderer
 class PodRenderer(CommandlineRenderer):
     def __init__(self):
         super(PodRenderer, self).__init__(
+            input_method=InputMethod.WORKER,
             executable='perl',
             args=['-MPod::Simple::HTML', '-e', 'Pod::Simple::HTML::go'])
 
+    def get_worker_command(self):
+        # Pod::Simple::HTML::go only converts a single document
+        return [self.get_executable(), os.path.join(__path__, 'bin/pod2html.pl'), '--worker']
+
     @classmethod
     def is_enabled(cls, filename, syntax):
         if syntax == 'source.perl':
@@ -1,9 +1,21 @@
 from .base_renderer import *
+import hashlib
+import io
 import os
 import re
+import threading
 import docutils.writers.html4css1
-from docutils.core import publish_parts
+from docutils import io as docutils_io
+from docutils.core import Publisher
+from docutils.nodes import fully_normalize_name, make_id
+from docutils.parsers.rst import Parser
+from docutils.parsers.rst.states import Inliner
+from docutils.readers.standalone import Reader
+from docutils.utils import DependencyList
 from docutils.writers.html4css1 import Writer, HTMLTranslator
+from .pygments_cache import install_docutils
+
+install_docutils()
 
 docutils_dir = os.path.dirname(docutils.writers.html4css1.__file__)
 
@@ -19,9 +31,292 @@ class GitHubHTMLTranslator(HTMLTranslator):
             self.body.append(self.starttag(node, 'pre', CLASS='codehilite'))
 
 
+class GitHubHTMLWriter(Writer):
+    """HTML writer using GitHubHTMLTranslator, with an already loaded template."""
+
+    def __init__(self, template):
+        Writer.__init__(self)
+        self.translator_class = GitHubHTMLTranslator
+        self.template = template
+
+    def apply_template(self):
+        return self.template % self.interpolation_dict()
+
+
+class RstSectionSplitter(object):
+    """Split reStructuredText source at top-level section titles.
+
+    Chunks are the text before the first section, then each top-level
+    section. Substitution definitions and external hyperlink targets (outside
+    of any block) are moved out of chunks into `definitions`, since they apply
+    document-wide. `splittable` is False if chunks may not render as they would
+    inside the whole document: with footnotes, citations, anonymous hyperlinks,
+    directives processing the whole document, references to names defined in
+    another section, inconsistent section levels, or names from different
+    chunks (or definitions) which would get the same id.
+    """
+
+    ADORNMENT_RE = re.compile(r'^([!-/:-@\[-`{-~])\1*\s*$')
+    TARGET_RE = re.compile(r'^\.\. _(`[^`]+`|[^:`][^:]*):(.*)$')
+    SUBSTITUTION_RE = re.compile(r'^\.\. \|[^|]+\|\s')
+    LITERAL_DIRECTIVE_RE = re.compile(r'^\.\. (code|code-block|sourcecode|math|raw)::')
+    NON_SPLITTABLE_RE = re.compile(
+        r'^\s*(\.\. \[|\.\. __:|__ |\.\. (contents|sectnum|section-numbering|target-notes|'
+        r'header|footer|title)::)')
+    # Inline literals and interpreted text with roles, which are never references
+    INLINE_LITERAL_RE = re.compile(r'``.+?``|:[\w.+-]+:`[^`]*`|`[^`]*`:[\w.+-]+:')
+    FOOTNOTE_REFERENCE_RE = re.compile(r'\[[^\]\s]+\]_')
+    PHRASE_RE = re.compile(r'`([^`]+)`(__?)?')
+    URL_RE = re.compile(r'\w+://\S+')
+    WORD_REFERENCE_RE = re.compile(r'(?:^|(?<=[\s\-:/\'"<(\[{]))(\w+(?:[-.+:]\w+)*)(__?)'
+                                   r'(?=$|[\s\-.,:;!?\\/\'")\]}>])')
+
+    def __init__(self, text):
+        self.chunks = []
+        self.definitions = []
+        self.splittable = True
+        self._split(text.split('\n'))
+
+    def _is_adornment(self, line):
+        return self.ADORNMENT_RE.match(line) is not None
+
+    def _title_at(self, lines, i):
+        """Get (style, title, number of lines) for a section title at line i, or None."""
+        line = lines[i]
+        if i > 0 and lines[i - 1].strip():
+            return None
+        if i + 2 < len(lines) and self._is_adornment(line) and lines[i + 1].strip() and \
+                lines[i + 2].rstrip() == line.rstrip():
+            return (line[0], True), lines[i + 1].strip(), 3
+        if i + 1 < len(lines) and line.strip() and not line[0].isspace() and \
+                not self._is_adornment(line) and self._is_adornment(lines[i + 1]):
+            underline = lines[i + 1].rstrip()
+            if len(underline) >= 4 or len(underline) >= len(line.rstrip()):
+                return (underline[0], False), line.strip(), 2
+        return None
+
+    def _target_name(self, m):
+        name = m.group(1)
+        if name.startswith('`'):
+            name = name[1:-1]
+        return fully_normalize_name(name)
+
+    def _split(self, lines):
+        # Section title styles in order of appearance, and the current level
+        styles = []
+        level = 0
+        chunk = []
+        # Style order, names defined and names referenced in the current chunk
+        chunk_styles = []
+        defined = set()
+        referenced = set()
+        chunks_names = [(defined, referenced)]
+        title_names = set()
+        external_targets = set()
+        literal_indent = None
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            stripped = line.lstrip()
+            indent = len(line) - len(stripped)
+            if literal_indent is not None:
+                if not stripped or indent > literal_indent:
+                    chunk.append(line)
+                    i += 1
+                    continue
+                literal_indent = None
+            if self.NON_SPLITTABLE_RE.match(line):
+                self.splittable = False
+                return
+            title = self._title_at(lines, i)
+            if title is not None:
+                style, text, num_lines = title
+                if style in styles:
+                    title_level = styles.index(style) + 1
+                    if title_level > level + 1:
+                        self.splittable = False
+                        return
+                elif len(styles) == level:
+                    styles.append(style)
+                    title_level = len(styles)
+                else:
+                    self.splittable = False
+                    return
+                level = title_level
+                name = fully_normalize_name(text)
+                if name in title_names or name in external_targets or not make_id(name):
+                    self.splittable = False
+                    return
+                title_names.add(name)
+                if title_level == 1:
+                    # Internal targets right before the title belong to it
+                    carried = []
+                    while chunk and (not chunk[-1].strip() or self.TARGET_RE.match(chunk[-1])):
+                        carried.insert(0, chunk.pop())
+                    if chunk_styles != styles[:len(chunk_styles)]:
+                        self.splittable = False
+                        return
+                    if chunk:
+                        self.chunks.append('\n'.join(chunk))
+                    chunk = carried
+                    chunk_styles = []
+                    carried_names = set(self._target_name(self.TARGET_RE.match(l))
+                                        for l in carried if l.strip())
+                    defined -= carried_names
+                    defined = carried_names
+                    referenced = set()
+                    chunks_names.append((defined, referenced))
+                if style not in chunk_styles:
+                    chunk_styles.append(style)
+                defined.add(name)
+                self._scan_inline(text, defined, referenced)
+                if not self.splittable:
+                    return
+                chunk.extend(lines[i:i + num_lines])
+                i += num_lines
+                continue
+            m = self.TARGET_RE.match(line)
+            if m:
+                name = self._target_name(m)
+                if m.group(2).strip() or (i + 1 < len(lines) and lines[i + 1][:1].isspace()):
+                    if name in title_names:
+                        self.splittable = False
+                        return
+                    external_targets.add(name)
+                    i = self._add_definition(lines, i)
+                    continue
+                defined.add(name)
+            elif self.SUBSTITUTION_RE.match(line):
+                i = self._add_definition(lines, i)
+                continue
+            if line.rstrip().endswith('::') and not stripped.startswith('.. ') or \
+                    self.LITERAL_DIRECTIVE_RE.match(stripped):
+                literal_indent = indent
+            if not stripped.startswith('.. '):
+                self._scan_inline(line, defined, referenced)
+                if not self.splittable:
+                    return
+            chunk.append(line)
+            i += 1
+        if chunk_styles != styles[:len(chunk_styles)]:
+            self.splittable = False
+        if chunk:
+            self.chunks.append('\n'.join(chunk))
+        for defined, referenced in chunks_names:
+            if not referenced <= (defined | external_targets):
+                self.splittable = False
+        # docutils numbers clashing ids document-wide, chunks rendered on
+        # their own would get the same ids instead
+        id_owners = {}
+        for index, (defined, referenced) in enumerate(chunks_names):
+            for name in defined:
+                id_owners.setdefault(make_id(name), set()).add(index)
+        for name in external_targets:
+            id_owners.setdefault(make_id(name), set()).add(None)
+        for owners in id_owners.values():
+            if len(owners) > 1:
+                self.splittable = False
+
+    def _add_definition(self, lines, i):
+        """Move the explicit markup block at line i to definitions."""
+        start = i
+        i += 1
+        while i < len(lines) and (not lines[i].strip() or lines[i][0].isspace()):
+            i += 1
+        end = i
+        while not lines[end - 1].strip():
+            end -= 1
+        definition = '\n'.join(lines[start:end])
+        # The same target may be defined several times
+        if definition not in self.definitions:
+            self.definitions.append(definition)
+        return i
+
+    def _scan_inline(self, line, defined, referenced):
+        line = self.INLINE_LITERAL_RE.sub('', line)
+        if self.FOOTNOTE_REFERENCE_RE.search(line):
+            self.splittable = False
+            return
+        for m in self.PHRASE_RE.finditer(line):
+            text, suffix = m.group(1), m.group(2)
+            if line[m.start() - 1:m.start()] == '_':
+                # Inline target
+                defined.add(fully_normalize_name(text))
+            elif suffix == '__':
+                self.splittable = False
+                return
+            elif suffix:
+                if text.endswith('>') and '<' in text:
+                    # Embedded URI, also defines a target named by the text
+                    defined.add(fully_normalize_name(text[:text.rindex('<')]))
+                else:
+                    referenced.add(fully_normalize_name(text))
+        line = self.URL_RE.sub('', self.PHRASE_RE.sub('', line))
+        for m in self.WORD_REFERENCE_RE.finditer(line):
+            if m.group(2) == '__':
+                self.splittable = False
+                return
+            referenced.add(fully_normalize_name(m.group(1)))
+
+
+class CancellableInliner(Inliner):
+    """Checks `cancel_token` whenever parsing the text of a paragraph, title...
+
+    Parsing is the longest stage of publishing, by far.
+    """
+
+    cancel_token = None
+
+    def parse(self, text, lineno, memo, parent):
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+        return Inliner.parse(self, text, lineno, memo, parent)
+
+
 @renderer
 class RstRenderer(MarkupRenderer):
+    OUT_OF_PROCESS = True
     FILENAME_PATTERN_RE = re.compile(r'\.re?st$')
+    # Ids docutils makes up for elements without a (unique) name
+    AUTO_ID_RE = re.compile(r'\bid="id\d+"')
+    # Directives and options reading other files, if file insertion gets
+    # enabled by docutils config files
+    FILE_INSERTION_RE = re.compile(r'^[ \t]*(\.\.[ \t]+include::|:(file|url):)', re.MULTILINE)
+
+    SETTINGS_OVERRIDES = {
+        'cloak_email_addresses': True,
+        'file_insertion_enabled': False,
+        'raw_enabled': False,
+        'strip_comments': True,
+        'doctitle_xform': False,
+        'report_level': 5,
+        'syntax_highlight': 'short',
+        'math_output': 'latex',
+        'input_encoding': 'utf-8',
+        'output_encoding': 'utf-8',
+        'stylesheet_dirs': [os.path.normpath(os.path.join(docutils_dir, Writer.default_stylesheet))],
+        'template': os.path.normpath(os.path.join(docutils_dir, Writer.default_template)),
+        # Propagate exceptions, as publish_parts() does
+        'traceback': True,
+    }
+
+    def __init__(self):
+        super(RstRenderer, self).__init__()
+        # (generation, settings, template), settings are only parsed (and
+        # config files read) once, the generation is bumped whenever they
+        # change, so per-thread components get rebuilt
+        self.engine_config = (0, None, None)
+        self.engine_lock = threading.Lock()
+        self.engines = threading.local()
+        self.incremental = False
+        self.fragments = new_fragments_cache()
+
+    def load_settings(self, renderer_options, global_setting):
+        super(RstRenderer, self).load_settings(renderer_options, global_setting)
+        with self.engine_lock:
+            self.engine_config = (self.engine_config[0] + 1, None, None)
+        self.incremental = renderer_options.get('incremental', False)
+        self.fragments.clear()
 
     @classmethod
     def is_enabled(cls, filename, syntax):
@@ -29,27 +324,106 @@ class RstRenderer(MarkupRenderer):
             return True
         return cls.FILENAME_PATTERN_RE.search(filename) is not None
 
+    def reads_other_files(self, text):
+        settings = self.get_engine_config()[1]
+        return (settings.file_insertion_enabled and
+                self.FILE_INSERTION_RE.search(text) is not None)
+
+    def get_engine_config(self):
+        with self.engine_lock:
+            generation, settings, template = self.engine_config
+            if settings is None:
+                parser = Parser()
+                publisher = Publisher(Reader(parser=parser), parser, Writer())
+                settings = publisher.get_settings(**self.SETTINGS_OVERRIDES)
+                with io.open(settings.template, encoding='utf-8') as f:
+                    template = f.read()
+                self.engine_config = (generation, settings, template)
+            return self.engine_config
+
+    def get_engine(self):
+        """Get (settings, reader, parser, writer) for the calling thread.
+
+        Settings are shared, and copied for each document, since transforms
+        may modify them.
+        """
+        engines = self.engines
+        generation, settings, template = self.get_engine_config()
+        if getattr(engines, 'generation', None) != generation:
+            engines.parser = Parser(inliner=CancellableInliner())
+            engines.reader = Reader(parser=engines.parser)
+            engines.writer = GitHubHTMLWriter(template)
+            engines.generation = generation
+        return settings, engines.reader, engines.parser, engines.writer
+
     def render(self, text, **kwargs):
-        settings_overrides = {
-            'cloak_email_addresses': True,
-            'file_insertion_enabled': False,
-            'raw_enabled': False,
-            'strip_comments': True,
-            'doctitle_xform': False,
-            'report_level': 5,
-            'syntax_highlight': 'short',
-            'math_output': 'latex',
-            'input_encoding': 'utf-8',
-            'output_encoding': 'utf-8',
-            'stylesheet_dirs': [os.path.normpath(os.path.join(docutils_dir, Writer.default_stylesheet))],
-            'template': os.path.normpath(os.path.join(docutils_dir, Writer.default_template))
-        }
-
-        writer = Writer()
-        writer.translator_class = GitHubHTMLTranslator
-        output = publish_parts(
-            text, writer=writer, settings_overrides=settings_overrides
-        )
+        if self.incremental:
+            fullpath = kwargs.get('fullpath', kwargs.get('filename', ''))
+            result = self.render_incremental(text, fullpath, kwargs.get('cancel_token'))
+            if result is not None:
+                return result
+        check_cancelled(kwargs)
+        output = self.render_parts(text, kwargs.get('cancel_token'))
         if 'html_body' in output:
             return output['html_body']
         return ''
+
+    def render_parts(self, text, cancel_token=None):
+        """Publish `text`, checking `cancel_token` between publishing stages."""
+        settings, reader, parser, writer = self.get_engine()
+        settings = settings.copy()
+        settings.record_dependencies = DependencyList()
+        publisher = Publisher(reader, parser, writer, settings=settings,
+                              source_class=docutils_io.StringInput,
+                              destination_class=docutils_io.StringOutput)
+        publisher.set_source(text)
+        publisher.set_destination()
+        parser.inliner.cancel_token = cancel_token
+        # The stages of Publisher.publish(), which propagates exceptions
+        # anyway, as "traceback" is set
+        publisher.document = reader.read(publisher.source, parser, settings)
+        if cancel_token is not None:
+            cancel_token.check()
+        publisher.apply_transforms()
+        if cancel_token is not None:
+            cancel_token.check()
+        writer.write(publisher.document, publisher.destination)
+        writer.assemble_parts()
+        return writer.parts
+
+    def render_incremental(self, text, fullpath, cancel_token=None):
+        """Render only sections changed since the last render of `fullpath`.
+
+        Returns None if the document can't be rendered section by section.
+        """
+        splitter = RstSectionSplitter(text)
+        if not splitter.splittable or len(splitter.chunks) < 2:
+            return None
+        # Definitions are appended to every section, so substitutions and
+        # links in unchanged sections stay correct, and editing a definition
+        # invalidates all sections at once.
+        definitions = '\n'.join(splitter.definitions)
+        old_fragments = self.fragments.get(fullpath, {})
+        fragments = {}
+        html_parts = []
+        for chunk in splitter.chunks:
+            source = chunk
+            if definitions:
+                source = chunk + '\n\n' + definitions
+            digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+            if digest in fragments:
+                html = fragments[digest]
+            elif digest in old_fragments:
+                html = old_fragments[digest]
+            else:
+                if cancel_token is not None:
+                    cancel_token.check()
+                output = self.render_parts(source, cancel_token)
+                html = output['docinfo'] + output['body']
+            fragments[digest] = html
+            html_parts.append(html)
+        self.fragments.set(fullpath, fragments)
+        if len([html for html in html_parts if self.AUTO_ID_RE.search(html)]) > 1:
+            # Numbered from 1 in each section, instead of across the document
+            return None
+        return '<div class="document">\n%s</div>\n' % ''.join(html_parts)
@@ -4,6 +4,7 @@ import textile
 
 @renderer
 class TextileRenderer(MarkupRenderer):
+    OUT_OF_PROCESS = True
     @classmethod
     def is_enabled(cls, filename, syntax):
         if syntax == 'text.html.textile':
@@ -27,15 +27,92 @@ import os
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+
+from ..RenderCache import LRUCache
 
 PY3K = sys.version_info >= (3, 0, 0)
 
+if PY3K:
+    import queue
+else:
+    import Queue as queue
+
+
+class RenderCancelled(Exception):
+    pass
+
+
+class CancelToken(object):
+    """Cancellation flag for a render, passed as the `cancel_token` argument.
+
+    Renderers call `check()` between their stages, and may register callbacks
+    (e.g. killing a child process) to run upon cancellation.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.callbacks = []
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def check(self):
+        if self.cancelled:
+            raise RenderCancelled()
+
+    def add_callback(self, callback):
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+
+def check_cancelled(kwargs):
+    """Raise RenderCancelled if the render with `kwargs` has been cancelled."""
+    cancel_token = kwargs.get('cancel_token')
+    if cancel_token is not None:
+        cancel_token.check()
+
+
+# Rendered fragments of recent documents, for incremental rendering
+FRAGMENTS_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+
+def fragments_size(fragments):
+    return sum(len(digest) + len(html) for digest, html in fragments.items())
+
+
+def new_fragments_cache():
+    """LRU cache of {source digest: html} dicts, keyed by document path."""
+    return LRUCache(FRAGMENTS_CACHE_MAX_BYTES, sizeof=fragments_size)
+
 
 class MarkupRenderer(object):
+    # Whether the renderer can run in a child python process (RendererProcessPool)
+    OUT_OF_PROCESS = False
+
     def __init__(self):
         self.renderer_options = {}
 
-    def load_settings(self, global_setting, renderer_options):
+    def load_settings(self, renderer_options, global_setting):
         self.renderer_options = renderer_options
 
     @classmethod
@@ -45,19 +122,257 @@ class MarkupRenderer(object):
     def render(self, text, **kwargs):
         raise NotImplementedError()
 
+    def reads_other_files(self, text):
+        """Whether rendering `text` reads other files (e.g. includes).
+
+        Such documents are never cached, as their text alone doesn't tell
+        whether a cached render is up to date.
+        """
+        return False
+
+    def shutdown(self):
+        """Release resources held by the renderer, called upon unloading."""
+        pass
+
 
 class InputMethod(object):
     STDIN = 1
     TEMPFILE = 2
     FILE = 3
+    # Long-running process (see PersistentWorker), falls back to STDIN
+    WORKER = 4
+
+
+class WorkerError(Exception):
+    pass
+
+
+class WorkerTimeout(WorkerError):
+    pass
+
+
+class PersistentWorker(object):
+    """A long-running renderer process, serving one document per request.
+
+    Requests and responses are framed with a length prefix over the process's
+    stdin/stdout (see bin/worker.rb):
+
+        request:  b"<length>\\n" + text
+        response: b"<status> <length>\\n" + result, status is OK or ERROR
+
+    The process is (re)started on demand, which also covers crashes, killed
+    when a request doesn't complete within `request_timeout` seconds, and
+    stopped after being idle for `idle_timeout` seconds. Cancelled requests
+    are left to complete, their responses are discarded by the next request.
+    """
+
+    def __init__(self, args, startupinfo=None, request_timeout=30, idle_timeout=300):
+        self.args = args
+        self.startupinfo = startupinfo
+        self.request_timeout = request_timeout
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.proc = None
+        self.responses = None
+        # Responses of cancelled requests, yet to be received
+        self.stale_responses = 0
+        self.idle_timer = None
+
+    def start(self):
+        """Start the worker process now, rather than on the first request."""
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self._stop()
+                self._start()
+
+    def _start(self):
+        try:
+            self.proc = subprocess.Popen(self.args, bufsize=-1,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         startupinfo=self.startupinfo)
+        except OSError as err:
+            raise WorkerError('Unable to start worker process: %s' % err)
+        self.responses = queue.Queue()
+        self.stale_responses = 0
+        for target, stream in ((self._read_responses, self.proc.stdout),
+                               (self._read_errors, self.proc.stderr)):
+            thread = threading.Thread(target=target, args=(stream, self.responses))
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def _read_responses(stream, responses):
+        try:
+            while True:
+                header = stream.readline()
+                if not header:
+                    break
+                status, length = header.decode('ascii').split()
+                length = int(length)
+                body = stream.read(length)
+                if len(body) != length:
+                    break
+                responses.put((status, body))
+        except Exception:
+            pass
+        # Process exited (or is talking nonsense)
+        responses.put(None)
+
+    @staticmethod
+    def _read_errors(stream, responses):
+        for line in iter(stream.readline, b''):
+            print(line.decode('utf-8', 'replace').rstrip())
+
+    def _stop(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+        try:
+            proc.kill()
+            proc.wait()
+        except Exception:
+            pass
+
+    def _on_idle(self, timer):
+        with self.lock:
+            # Ignore stale timers, the worker may have been used since
+            if timer is self.idle_timer:
+                self._stop()
+
+    def _reset_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        if self.idle_timeout > 0:
+            timer = threading.Timer(self.idle_timeout, lambda: self._on_idle(timer))
+            timer.daemon = True
+            self.idle_timer = timer
+            timer.start()
+
+    def _get_response(self, cancelled):
+        """Get the response to the pending request, None if the process exited.
+
+        Returns `cancelled` if it gets put in the queue meanwhile.
+        """
+        while True:
+            try:
+                response = self.responses.get(timeout=self.request_timeout)
+            except queue.Empty:
+                self._stop()
+                raise WorkerTimeout('Worker request timed out after %s seconds'
+                                    % self.request_timeout)
+            if response is None:
+                self._stop()
+                return None
+            if response is cancelled:
+                return response
+            if not isinstance(response, tuple):
+                # An earlier request cancelled after its response was received
+                continue
+            if self.stale_responses == 0:
+                return response
+            self.stale_responses -= 1
+
+    def _request(self, data, cancel_token):
+        if self.proc is None or self.proc.poll() is not None:
+            self._stop()
+            self._start()
+        if cancel_token is not None:
+            cancel_token.check()
+        try:
+            self.proc.stdin.write(('%d\n' % len(data)).encode('ascii'))
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except (IOError, OSError, ValueError):
+            self._stop()
+            raise WorkerError('Worker process exited unexpectedly')
+        # Not killing the process upon cancellation, starting a new one would
+        # take longer than most renders
+        responses = self.responses
+        cancelled = object()
+        cancel = lambda: responses.put(cancelled)
+        if cancel_token is not None:
+            cancel_token.add_callback(cancel)
+        try:
+            response = self._get_response(cancelled)
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(cancel)
+        if response is None:
+            raise WorkerError('Worker process exited unexpectedly')
+        if response is cancelled:
+            self.stale_responses += 1
+            cancel_token.check()
+        return response
+
+    def request(self, data, cancel_token=None):
+        """Send `data` (bytes) to the worker process and return its result.
+
+        WorkerError is raised if the worker process can't be used; rendering
+        errors reported by the worker are raised as RuntimeError. Cancelling
+        `cancel_token` raises RenderCancelled, without waiting for the result.
+        """
+        with self.lock:
+            reused = self.proc is not None and self.proc.poll() is None
+            try:
+                try:
+                    status, result = self._request(data, cancel_token)
+                except WorkerTimeout:
+                    raise
+                except WorkerError:
+                    if not reused:
+                        raise
+                    # The process may have died since the last request, retry
+                    # once with a new one.
+                    status, result = self._request(data, cancel_token)
+            finally:
+                self._reset_idle_timer()
+        if status != 'OK':
+            raise RuntimeError(result.decode('utf-8', 'replace'))
+        return result
+
+    def shutdown(self):
+        with self.lock:
+            self._stop()
 
 
 class CommandlineRenderer(MarkupRenderer):
-    def __init__(self, input_method=InputMethod.STDIN, executable=None, args=[]):
+    # Seconds to render with one-shot processes after the persistent worker
+    # failed, rather than trying to start it again on every render
+    WORKER_RETRY_DELAY = 60
+
+    def __init__(self, input_method=InputMethod.STDIN, executable=None, args=[],
+                 worker_args=['--worker']):
         super(CommandlineRenderer, self).__init__()
         self.input_method = input_method
         self.executable = executable
         self.args = args
+        self.worker_args = worker_args
+        self.worker_enabled = True
+        self.worker_request_timeout = 30
+        self.worker_idle_timeout = 300
+        self.worker = None
+        self.worker_lock = threading.Lock()
+        self.worker_retry_time = 0
+
+    def load_settings(self, renderer_options, global_setting):
+        super(CommandlineRenderer, self).load_settings(renderer_options, global_setting)
+        self.worker_enabled = global_setting.get_setting('persistent_workers_enabled', True)
+        self.worker_request_timeout = global_setting.get_setting(
+            'persistent_worker_request_timeout', 30)
+        self.worker_idle_timeout = global_setting.get_setting(
+            'persistent_worker_idle_timeout', 300)
+        # Settings are taken into account when the worker is restarted
+        self.shutdown()
+        self.worker_retry_time = 0
 
     def pre_process_encoding(self, text, **kwargs):
         return text.encode('utf-8')
@@ -74,17 +389,54 @@ class CommandlineRenderer(MarkupRenderer):
     def render(self, text, **kwargs):
         text = self.pre_process_encoding(text, **kwargs)
         text = self.pre_process(text, **kwargs)
-        text = self.executable_check(text, kwargs['filename'])
+        check_cancelled(kwargs)
+        text = self.executable_check(text, kwargs['filename'],
+                                     cancel_token=kwargs.get('cancel_token'))
+        check_cancelled(kwargs)
         text = self.post_process_encoding(text, **kwargs)
         return self.post_process(text, **kwargs)
 
-    def executable_check(self, text, filename):
+    def get_worker_command(self):
+        return [self.get_executable()] + self.get_args() + self.worker_args
+
+    def get_worker(self):
+        with self.worker_lock:
+            if self.worker is None:
+                args = self.get_worker_command()
+                self.worker = PersistentWorker(args, startupinfo=self.get_startupinfo(),
+                                               request_timeout=self.worker_request_timeout,
+                                               idle_timeout=self.worker_idle_timeout)
+            return self.worker
+
+    def shutdown(self):
+        with self.worker_lock:
+            worker, self.worker = self.worker, None
+        if worker is not None:
+            worker.shutdown()
+
+    def executable_check(self, text, filename, cancel_token=None):
+        """Run the executable on `text`, returns its output.
+
+        Raises RuntimeError if it fails, WorkerTimeout if the persistent worker
+        takes too long.
+        """
         tempfile_ = None
         result = ''
 
+        if (self.input_method == InputMethod.WORKER and self.worker_enabled and
+                time.time() >= self.worker_retry_time):
+            try:
+                return self.get_worker().request(text, cancel_token).strip()
+            except WorkerTimeout:
+                raise
+            except WorkerError as err:
+                self.worker_retry_time = time.time() + self.WORKER_RETRY_DELAY
+                print('Persistent worker failed (%s), falling back to one-shot processes '
+                      'for %d seconds: %s' % (err, self.WORKER_RETRY_DELAY, self.executable))
+
         try:
             args = [self.get_executable()]
-            if self.input_method == InputMethod.STDIN:
+            if self.input_method in (InputMethod.STDIN, InputMethod.WORKER):
                 args.extend(self.get_args())
             elif self.input_method == InputMethod.TEMPFILE:
                 _, ext = os.path.splitext(filename)
@@ -104,7 +456,18 @@ class CommandlineRenderer(MarkupRenderer):
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.PIPE,
                                     startupinfo=self.get_startupinfo())
-            result, errdata = proc.communicate(text)
+            if cancel_token is not None:
+                cancel_token.add_callback(proc.kill)
+            try:
+                result, errdata = proc.communicate(text)
+            finally:
+                if cancel_token is not None:
+                    cancel_token.remove_callback(proc.kill)
+            if cancel_token is not None:
+                cancel_token.check()
+            if proc.returncode != 0:
+                raise RuntimeError('%s exited with %d: %s' % (
+                    self.executable, proc.returncode, errdata.decode('utf-8', 'replace')))
             if len(errdata) > 0:
                 print(errdata)
         finally:
@@ -130,12 +493,17 @@ class CommandlineRenderer(MarkupRenderer):
         return [arg.format(filename=filename) for arg in args]
 
     def get_startupinfo(self):
-        if os.name != 'nt':
-            return None
-        info = subprocess.STARTUPINFO()
-        info.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        info.wShowWindow = subprocess.SW_HIDE
-        return info
+        return get_startupinfo()
+
+
+def get_startupinfo():
+    """Startup info for hiding console windows of child processes."""
+    if os.name != 'nt':
+        return None
+    info = subprocess.STARTUPINFO()
+    info.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    info.wShowWindow = subprocess.SW_HIDE
+    return info
 
 
 def renderer(renderer_type):
@@ -1,12 +1,7 @@
 # -*- coding: utf-8 -*-
 require 'asciidoctor'
+require File.expand_path('../worker', __FILE__)
 
-# Force utf-8 encoding
-begin
-    $stdin.set_encoding 'utf-8'
-    $stdout.set_encoding 'utf-8'
-rescue
+OmniMarkupWorker.run do |text|
+    Asciidoctor::Document.new(text).render
 end
-
-text = $stdin.read
-$stdout.write Asciidoctor::Document.new(text).render
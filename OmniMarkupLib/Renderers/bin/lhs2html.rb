@@ -1,12 +1,7 @@
 # -*- coding: utf-8 -*-
 require 'literati'
+require File.expand_path('../worker', __FILE__)
 
-# Force utf-8 encoding
-begin
-    $stdin.set_encoding 'utf-8'
-    $stdout.set_encoding 'utf-8'
-rescue
+OmniMarkupWorker.run do |text|
+    Literati.render(text)
 end
-
-text = $stdin.read
-$stdout.write Literati.render(text)
@@ -1,13 +1,8 @@
 # -*- coding: utf-8 -*-
 require 'wikicloth'
+require File.expand_path('../worker', __FILE__)
 
-# Force utf-8 encoding
-begin
-    $stdin.set_encoding 'utf-8'
-    $stdout.set_encoding 'utf-8'
-rescue
+OmniMarkupWorker.run do |text|
+    conv = WikiCloth::WikiCloth.new(:data => text)
+    conv.to_html(:noedit => true)
 end
-
-text = $stdin.read
-conv = WikiCloth::WikiCloth.new(:data => text)
-$stdout.write conv.to_html(:noedit => true)
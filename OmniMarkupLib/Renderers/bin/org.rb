@@ -1,12 +1,7 @@
 # -*- coding: utf-8 -*-
 require 'org-ruby'
+require File.expand_path('../worker', __FILE__)
 
-# Force utf-8 encoding
-begin
-    $stdin.set_encoding 'utf-8'
-    $stdout.set_encoding 'utf-8'
-rescue
+OmniMarkupWorker.run do |text|
+    Orgmode::Parser.new(text).to_html
 end
-
-text = $stdin.read
-$stdout.write Orgmode::Parser.new(text).to_html
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+# Converts POD to HTML with Pod::Simple::HTML, like
+#   perl -MPod::Simple::HTML -e Pod::Simple::HTML::go
+# but when started with `--worker`, converts one document per request, using
+# the framing described in worker.rb.
+
+use strict;
+use warnings;
+use Pod::Simple::HTML;
+
+sub render {
+    my ($text) = @_;
+    my $html = '';
+    my $parser = Pod::Simple::HTML->new;
+    $parser->output_string(\$html);
+    $parser->parse_string_document($text);
+    utf8::encode($html) if utf8::is_utf8($html);
+    return $html;
+}
+
+sub serve {
+    while (defined(my $header = <STDIN>)) {
+        my $length = int($header);
+        my $text = '';
+        while (length($text) < $length) {
+            my $count = read(STDIN, $text, $length - length($text), length($text));
+            last unless $count;
+        }
+        last if length($text) < $length;
+
+        my ($status, $result) = ('OK', '');
+        unless (eval { $result = render($text); 1 }) {
+            ($status, $result) = ('ERROR', "$@");
+            utf8::encode($result) if utf8::is_utf8($result);
+        }
+        print STDOUT "$status " . length($result) . "\n";
+        print STDOUT $result;
+    }
+}
+
+binmode STDIN;
+binmode STDOUT;
+$| = 1;
+
+if (grep { $_ eq '--worker' } @ARGV) {
+    serve();
+} else {
+    local $/;
+    print STDOUT render(<STDIN>);
+}
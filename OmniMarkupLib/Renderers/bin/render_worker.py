@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Renders documents with the pure python renderers, out of the plugin host.
+
+Started by RendererProcessPool as `python render_worker.py --worker
+[RendererClass...]`; the given renderer modules (and their libraries) are
+imported upfront. Uses the framing described in worker.rb, with a JSON
+request:
+
+    {"renderer": "MarkdownRenderer", "options": {...}, "global_setting": {...},
+     "filename": "README.md", "fullpath": "/path/to/README.md", "text": "..."}
+
+and a JSON response, with the rendered HTML and the Pygments lexers used by
+the process so far:
+
+    {"html": "...", "lexers": ["python", ...]}
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import traceback
+
+__file__ = os.path.normpath(os.path.abspath(__file__))
+__path__ = os.path.dirname(__file__)
+
+PY3K = sys.version_info >= (3, 0, 0)
+RENDERERS_DIR = os.path.dirname(__path__)
+PACKAGE_DIR = os.path.dirname(os.path.dirname(RENDERERS_DIR))
+LIBS_DIR = os.path.join(RENDERERS_DIR, 'libs')
+
+sys.path.insert(0, PACKAGE_DIR)
+sys.path.append(LIBS_DIR)
+sys.path.append(os.path.join(LIBS_DIR, 'python3' if PY3K else 'python2'))
+
+if PY3K:
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+else:
+    stdin, stdout = sys.stdin, sys.stdout
+    if os.name == 'nt':
+        import msvcrt
+        msvcrt.setmode(stdin.fileno(), os.O_BINARY)
+        msvcrt.setmode(stdout.fileno(), os.O_BINARY)
+# Nothing but responses may be written to stdout
+sys.stdout = sys.stderr
+
+
+class GlobalSetting(object):
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def get_setting(self, k, default=None):
+        return getattr(self, k, default)
+
+
+def load_renderer_class(classname):
+    modname = 'OmniMarkupLib.Renderers.' + classname
+    __import__(modname)
+    return getattr(sys.modules[modname], classname)
+
+
+# (renderer classname, options) -> renderer instance
+renderers = {}
+
+
+def get_renderer(classname, options, global_setting):
+    key = json.dumps([classname, options, global_setting], sort_keys=True)
+    if key not in renderers:
+        renderer = load_renderer_class(classname)()
+        renderer.load_settings(options, GlobalSetting(global_setting))
+        renderers[key] = renderer
+    return renderers[key]
+
+
+def render(data):
+    request = json.loads(data.decode('utf-8'))
+    renderer = get_renderer(request['renderer'], request['options'],
+                            request['global_setting'])
+    html = renderer.render(request['text'], filename=request['filename'],
+                           fullpath=request.get('fullpath', request['filename']))
+    from OmniMarkupLib.Renderers import pygments_cache
+    return json.dumps({'html': html, 'lexers': pygments_cache.used_aliases})
+
+
+def serve():
+    while True:
+        header = stdin.readline()
+        if not header:
+            break
+        length = int(header)
+        data = stdin.read(length)
+        if len(data) != length:
+            break
+        try:
+            status, result = b'OK', render(data).encode('utf-8')
+        except Exception:
+            status, result = b'ERROR', traceback.format_exc().encode('utf-8')
+        stdout.write(status + b' ' + str(len(result)).encode('ascii') + b'\n')
+        stdout.write(result)
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    for classname in sys.argv[1:]:
+        if classname != '--worker':
+            load_renderer_class(classname)
+    serve()
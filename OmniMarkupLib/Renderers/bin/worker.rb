@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#
+# Shared driver for the renderer scripts.
+#
+# By default a script renders $stdin to $stdout once. When started with
+# `--worker`, it keeps running and renders one document per request instead,
+# so the interpreter and gems are loaded only once. Both directions use the
+# same framing:
+#
+#   request:  "<length>\n" followed by <length> bytes of utf-8 text
+#   response: "<status> <length>\n" followed by <length> bytes, where status
+#             is either OK (rendered html) or ERROR (error message)
+#
+# The worker exits when its stdin is closed.
+
+module OmniMarkupWorker
+    def self.binary(str)
+        str = str.dup
+        str.force_encoding('binary') if str.respond_to?(:force_encoding)
+        str
+    end
+
+    def self.utf8(str)
+        str.force_encoding('utf-8') if str.respond_to?(:force_encoding)
+        str
+    end
+
+    def self.serve
+        $stdin.binmode
+        $stdout.binmode
+        while (header = $stdin.gets)
+            length = Integer(header.strip)
+            text = length > 0 ? $stdin.read(length) : ''
+            break if text.nil?
+            begin
+                status, result = 'OK', yield(utf8(text)).to_s
+            rescue Exception => e
+                status, result = 'ERROR', "#{e.class}: #{e.message}"
+            end
+            result = binary(result)
+            $stdout.write("#{status} #{result.size}\n")
+            $stdout.write(result)
+            $stdout.flush
+        end
+    end
+
+    def self.run(&render)
+        if ARGV.include?('--worker')
+            serve(&render)
+        else
+            # Force utf-8 encoding
+            begin
+                $stdin.set_encoding 'utf-8'
+                $stdout.set_encoding 'utf-8'
+            rescue
+            end
+
+            $stdout.write render.call($stdin.read)
+        end
+    end
+end
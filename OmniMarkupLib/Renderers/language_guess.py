@@ -0,0 +1,157 @@
+"""
+Copyright (c) 2013 Timon Wong
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import json
+import re
+
+# Only the beginning of a code block is looked at
+MAX_SCAN_LENGTH = 4096
+# A language needs at least this score, and a better one than any other
+MIN_SCORE = 2
+
+SHEBANG_RE = re.compile(r'\A#!\s*(?:\S*/)?(?:env\s+(?:-\S+\s+)*)?([A-Za-z]+)')
+SHEBANG_INTERPRETERS = {
+    'bash': 'bash',
+    'dash': 'bash',
+    'ksh': 'bash',
+    'sh': 'bash',
+    'zsh': 'bash',
+    'lua': 'lua',
+    'node': 'javascript',
+    'nodejs': 'javascript',
+    'perl': 'perl',
+    'php': 'php',
+    'python': 'python',
+    'pypy': 'python',
+    'ruby': 'ruby',
+    'tclsh': 'tcl',
+}
+# vim: ft=python / vim: set filetype=python:
+MODELINE_RE = re.compile(r'(?:vi|vim|ex)(?:[<=>]?\d*)?:.*(?:ft|filetype|syn|syntax)=([A-Za-z0-9_+-]+)')
+
+# (alias, pattern, score), every pattern found adds its score to the alias
+FINGERPRINTS = [
+    ('python', r'^[ \t]*def \w+\(.*\)[ \t]*(->.*)?:[ \t]*$', 2),
+    ('python', r'^[ \t]*class \w+(\(.*\))?:[ \t]*$', 2),
+    ('python', r'^[ \t]*(from [\w.]+ import |import [\w.]+( as \w+)?[ \t]*$)', 2),
+    ('python', r'^[ \t]*(elif |except\b.*:|if __name__ == )', 2),
+    ('python', r'\bself\.\w+', 1),
+    ('pycon', r'^>>> ', 4),
+    ('ruby', r'^[ \t]*def (self\.)?\w+[?!]?(\(.*\))?[ \t]*$', 2),
+    ('ruby', r'^[ \t]*end[ \t]*$', 1),
+    ('ruby', r'^[ \t]*require [\'"]', 2),
+    ('ruby', r'\bdo( \|[\w, ]+\|)?[ \t]*$|\bputs\b|\battr_accessor\b', 1),
+    ('javascript', r'\bfunction\s*\w*\s*\([^)]*\)\s*\{', 2),
+    ('javascript', r'^[ \t]*(const|let|var) [\w$]+\s*=', 2),
+    ('javascript', r'\bconsole\.log\(|\bdocument\.\w+|\brequire\([\'"]|=>\s*\{', 2),
+    ('c', r'^[ \t]*#[ \t]*include\s*[<"]', 2),
+    ('c', r'^[ \t]*#[ \t]*(define|ifn?def|endif)\b', 2),
+    ('c', r'\b(int|void|char|unsigned|static)\s+\**\w+\s*\([^)]*\)\s*\{?[ \t]*$', 2),
+    ('c', r'\b(printf|malloc|free|sizeof)\s*\(', 1),
+    ('cpp', r'\bstd::|\bcout\s*<<|\btemplate\s*<|^[ \t]*namespace \w+|'
+            r'#include\s*<(iostream|vector|string|map|memory|algorithm)>', 5),
+    ('java', r'^[ \t]*(public|private|protected) (static |final |abstract )*(class|interface|enum|void) ', 3),
+    ('java', r'\bSystem\.(out|err)\.print|^import java\.', 3),
+    ('csharp', r'^using System\b|\bConsole\.Write', 3),
+    ('objective-c', r'^@(interface|implementation|end)\b|\[\[\w+ alloc\]', 3),
+    ('go', r'^package \w+[ \t]*$', 3),
+    ('go', r'^func (\([^)]*\) )?\w+\(', 3),
+    ('go', r'\bfmt\.\w+\(|:=', 1),
+    ('rust', r'^[ \t]*(pub )?fn \w+', 3),
+    ('rust', r'\blet mut\b|^[ \t]*use \w+::|\bprintln!\(', 2),
+    ('perl', r'^[ \t]*(my|our) [$@%]\w+|^use strict;', 3),
+    ('php', r'<\?php', 5),
+    ('html', r'<!DOCTYPE html|<html[\s>]', 5),
+    ('html', r'^[ \t]*<(div|span|p|a|ul|ol|li|table|head|body|script|style|link|meta|form)[\s>]', 2),
+    ('xml', r'\A\s*<\?xml ', 5),
+    ('css', r'^[ \t]*[.#]?[\w-]+([ \t]*[,>+~]?[ \t]*[.#:]{0,2}[\w-]+)*[ \t]*\{[ \t]*$', 1),
+    ('css', r'^[ \t]*[\w-]+[ \t]*:[ \t]*[^;{}]+;[ \t]*$', 1),
+    ('css', r'^[ \t]*@(media|import|font-face|keyframes)\b', 2),
+    ('sql', r'(?i)^[ \t]*(SELECT\s.*\sFROM\s|INSERT\s+INTO\s|UPDATE\s+\w+\s+SET\s|DELETE\s+FROM\s|'
+            r'(CREATE|ALTER|DROP)\s+(TABLE|INDEX|VIEW|DATABASE)\s)', 3),
+    ('console', r'^\$ \S', 3),
+    ('bash', r'^[ \t]*(sudo|apt-get|yum|brew|pip|npm|git|cd|export|echo|mkdir|rm|cp|mv|'
+             r'curl|wget|chmod|chown|source|tar|ls)[ \t]', 2),
+    ('bash', r'^[ \t]*(if \[|for \w+ in .*; do|fi|done|esac)\b', 2),
+    ('diff', r'^(---|\+\+\+) \S', 2),
+    ('diff', r'^@@ -\d+(,\d+)? \+\d+(,\d+)? @@', 3),
+    ('yaml', r'^[\w-]+:[ \t]+\S.*\n[\w-]+:([ \t]+\S|[ \t]*$)', 2),
+    ('yaml', r'\A---[ \t]*$|^[ \t]*- [\w-]+:[ \t]', 1),
+    ('ini', r'^\[[\w .-]+\][ \t]*$', 1),
+    ('ini', r'^[\w.-]+[ \t]*=[ \t]*\S', 1),
+    ('docker', r'^FROM \S+', 2),
+    ('docker', r'^(RUN|CMD|ENTRYPOINT|COPY|ADD|WORKDIR|EXPOSE|ENV) ', 2),
+    ('make', r'^[\w./-]+:.*\n\t', 3),
+    ('tex', r'\\(documentclass|usepackage|begin\{\w+\})', 3),
+]
+FINGERPRINTS = [(alias, re.compile(pattern, re.MULTILINE), score)
+                for alias, pattern, score in FINGERPRINTS]
+
+
+def guess_from_header(code):
+    """Look for a shebang or a vim modeline."""
+    m = SHEBANG_RE.match(code)
+    if m:
+        alias = SHEBANG_INTERPRETERS.get(m.group(1))
+        if alias:
+            return alias
+    lines = code.split('\n', 2)[:2] + code.rsplit('\n', 2)[-2:]
+    for line in lines:
+        m = MODELINE_RE.search(line)
+        if m:
+            return m.group(1)
+    return None
+
+
+def guess_from_fingerprints(code):
+    scores = {}
+    for alias, pattern, score in FINGERPRINTS:
+        if pattern.search(code):
+            scores[alias] = scores.get(alias, 0) + score
+    if not scores:
+        return None
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    alias, score = ranked[0]
+    if score < MIN_SCORE or (len(ranked) > 1 and ranked[1][1] == score):
+        return None
+    return alias
+
+
+def guess_language(code):
+    """Guess the language of a code block, without loading any lexer.
+
+    Returns a Pygments alias, or None when the language can't be told with
+    some confidence.
+    """
+    code = code.lstrip('\n')[:MAX_SCAN_LENGTH]
+    if not code.strip():
+        return None
+    alias = guess_from_header(code)
+    if alias:
+        return alias
+    if code.lstrip()[:1] in ('{', '[') and len(code) < MAX_SCAN_LENGTH:
+        try:
+            json.loads(code)
+            return 'json'
+        except ValueError:
+            pass
+    return guess_from_fingerprints(code)
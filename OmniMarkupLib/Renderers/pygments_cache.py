@@ -0,0 +1,252 @@
+"""
+Copyright (c) 2013 Timon Wong
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import hashlib
+import re
+import threading
+import time
+
+from ..RenderCache import LRUCache
+from .language_guess import guess_language
+
+try:
+    import pygments
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_by_name as pygments_get_lexer_by_name
+    from pygments.lexers import get_lexer_for_filename, _iter_lexerclasses
+    from pygments.util import ClassNotFound
+except ImportError:
+    pygments = None
+
+# Highlighted code, as HTML (markdown) or as tokens (docutils)
+HIGHLIGHT_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+
+def highlighted_size(value):
+    if isinstance(value, tuple):
+        # Tokens, with a rough per token overhead
+        return sum(len(text) + 64 for _, text in value)
+    return len(value)
+
+
+HIGHLIGHT_CACHE = LRUCache(HIGHLIGHT_CACHE_MAX_BYTES, sizeof=highlighted_size)
+
+# (alias, options) -> lexer, lexers keep no state between get_tokens() calls
+_lexers = {}
+_lexers_lock = threading.Lock()
+# Lexer aliases asked for by renderers, in order of first use
+used_aliases = []
+# Formatters are kept per thread, (options) -> formatter
+_formatters = threading.local()
+
+# Languages given as a file extension, like ```rb or ```{.hs}
+EXTENSION_RE = re.compile(r'^[A-Za-z0-9_+-]{1,10}$')
+# Seconds Pygments' own guess_lexer() may spend on a code block which the
+# language index couldn't tell, 0 to not use it
+guess_lexer_timeout = 0
+
+
+def options_key(options):
+    return repr(sorted(options.items()))
+
+
+def code_digest(code):
+    return hashlib.sha1(code.encode('utf-8')).hexdigest()
+
+
+def _get_lexer_by_name(alias, options):
+    key = (alias, options_key(options))
+    lexer = _lexers.get(key)
+    if lexer is None:
+        lexer = pygments_get_lexer_by_name(alias, **options)
+        with _lexers_lock:
+            _lexers[key] = lexer
+    return lexer
+
+
+def _get_lexer_by_hint(hint, options):
+    try:
+        return _get_lexer_by_name(hint, options)
+    except ClassNotFound:
+        if not hint or not EXTENSION_RE.match(hint):
+            raise
+    key = ('*.' + hint, options_key(options))
+    if key not in _lexers:
+        try:
+            lexer = get_lexer_for_filename('file.' + hint, **options)
+        except ClassNotFound:
+            lexer = None
+        with _lexers_lock:
+            _lexers[key] = lexer
+    lexer = _lexers[key]
+    if lexer is None:
+        raise ClassNotFound('no lexer for alias or extension %r found' % hint)
+    return lexer
+
+
+def record_use(alias):
+    if alias not in used_aliases:
+        with _lexers_lock:
+            if alias not in used_aliases:
+                used_aliases.append(alias)
+
+
+def get_lexer_by_name(alias, **options):
+    """Cached version of pygments.lexers.get_lexer_by_name()."""
+    lexer = _get_lexer_by_name(alias, options)
+    record_use(alias)
+    return lexer
+
+
+def get_lexer_by_hint(hint, **options):
+    """Like get_lexer_by_name(), also accepting file extensions as the hint."""
+    lexer = _get_lexer_by_hint(hint, options)
+    record_use(hint)
+    return lexer
+
+
+def warm_up(aliases, pause=0.05):
+    """Load lexers ahead of their first use.
+
+    Sleeps `pause` seconds between lexers, not to hold the GIL for too long.
+    Returns the time it took to load each lexer, as (alias, seconds).
+    """
+    timings = []
+    if pygments is None:
+        return timings
+    for alias in aliases:
+        start = time.time()
+        try:
+            _get_lexer_by_hint(alias, {})
+        except ClassNotFound:
+            continue
+        timings.append((alias, time.time() - start))
+        time.sleep(pause)
+    return timings
+
+
+def guess_lexer_class(code, timeout):
+    """Pygments' guess_lexer(), giving up after `timeout` seconds."""
+    deadline = time.time() + timeout
+    best_score, best_class = 0.0, None
+    # Lexer modules get imported while iterating, which is what takes time
+    for lexer_class in _iter_lexerclasses():
+        score = lexer_class.analyse_text(code)
+        if score == 1.0:
+            return lexer_class
+        if score > best_score:
+            best_score, best_class = score, lexer_class
+        if time.time() > deadline:
+            break
+    return best_class
+
+
+def guess_alias(code):
+    alias = guess_language(code)
+    if alias or guess_lexer_timeout <= 0:
+        return alias
+    key = ('guess', guess_lexer_timeout, code_digest(code))
+    alias = HIGHLIGHT_CACHE.get(key)
+    if alias is None:
+        lexer_class = guess_lexer_class(code, guess_lexer_timeout)
+        alias = ''
+        if lexer_class is not None and lexer_class.aliases:
+            alias = lexer_class.aliases[0]
+        HIGHLIGHT_CACHE.set(key, alias)
+    return alias
+
+
+def guess_lexer(code, **options):
+    """Replacement of pygments.lexers.guess_lexer().
+
+    Common languages are told from a shebang, a modeline or keywords, without
+    loading any lexer module. Pygments' guess_lexer(), which imports all of
+    them, is only used when `guess_lexer_timeout` is set.
+    """
+    alias = guess_alias(code)
+    if not alias:
+        raise ClassNotFound('no lexer matching the text found')
+    return get_lexer_by_name(alias, **options)
+
+
+def configure_guessing(timeout_ms):
+    global guess_lexer_timeout
+    guess_lexer_timeout = max(0, timeout_ms) / 1000.0
+
+
+def get_html_formatter(**options):
+    """Get an `HtmlFormatter`, which computes style tables upon creation, from a pool."""
+    pool = getattr(_formatters, 'pool', None)
+    if pool is None:
+        pool = _formatters.pool = {}
+    key = options_key(options)
+    formatter = pool.get(key)
+    if formatter is None:
+        formatter = pool[key] = HtmlFormatter(**options)
+    return formatter
+
+
+def highlight(code, lexer, formatter):
+    """Cached version of pygments.highlight(), returning the result."""
+    key = ('html', type(lexer).__name__, options_key(lexer.options),
+           type(formatter).__name__, options_key(formatter.options), code_digest(code))
+    html = HIGHLIGHT_CACHE.get(key)
+    if html is None:
+        html = pygments.highlight(code, lexer, formatter)
+        HIGHLIGHT_CACHE.set(key, html)
+    return html
+
+
+def install_markdown():
+    """Make the codehilite markdown extension highlight through the cache."""
+    if pygments is None:
+        return
+    from markdown.extensions import codehilite
+    codehilite.highlight = highlight
+    codehilite.get_lexer_by_name = get_lexer_by_hint
+    codehilite.guess_lexer = guess_lexer
+    codehilite.HtmlFormatter = get_html_formatter
+
+
+def install_docutils():
+    """Make docutils' code directive and role tokenize through the cache."""
+    if pygments is None:
+        return
+    from docutils.utils import code_analyzer
+    if getattr(code_analyzer.Lexer, 'highlight_cache_installed', False):
+        return
+    code_analyzer.get_lexer_by_name = get_lexer_by_name
+    lexer_iter = code_analyzer.Lexer.__iter__
+
+    def cached_iter(self):
+        if self.lexer is None:
+            return lexer_iter(self)
+        key = ('tokens', self.language, self.tokennames, code_digest(self.code))
+        tokens = HIGHLIGHT_CACHE.get(key)
+        if tokens is None:
+            tokens = tuple(lexer_iter(self))
+            HIGHLIGHT_CACHE.set(key, tokens)
+        # Class lists end up in document nodes, which may modify them
+        return iter([(list(classes), text) for classes, text in tokens])
+
+    code_analyzer.Lexer.__iter__ = cached_iter
+    code_analyzer.Lexer.highlight_cache_installed = True
@@ -23,9 +23,16 @@ SOFTWARE.
 import sublime
 
 import base64
+import difflib
+import json
+import mimetypes
 import os
+import re
 import sys
 import threading
+import zlib
+
+from time import time
 
 from . import log, LibraryPathManager
 from .Setting import Setting
@@ -43,7 +50,11 @@ from cherrypy import wsgiserver
 import bottle
 # bottle.debug(True)
 from bottle import Bottle, ServerAdapter
-from bottle import static_file, request, template
+from bottle import request, response, template
+
+from .ImageProxy import ImageProxy
+from .StaticFiles import (FILE_CONTENT_CACHE, PRECOMPRESSED, STAT_CACHE, public_cache_control,
+                          safe_join, serve_file)
 
 try:
     from urllib.parse import unquote
@@ -55,11 +66,29 @@ DEFAULT_STATIC_FILES_DIR = os.path.normpath(os.path.join(__path__, '..', 'public
 USER_STATIC_FILES_DIR = None
 DEFAULT_TEMPLATE_FILES_DIR = os.path.normpath(os.path.join(__path__, '..', 'templates'))
 USER_TEMPLATE_FILES_DIR = None
+THUMBNAIL_CACHE_DIR = None
+# Downscaled copies of large local images
+IMAGE_PROXY = ImageProxy()
+
+# Long polling requests may hold all server threads but one, (re)created
+# when the CherryPy server starts
+LONG_POLLING_SLOTS = threading.Semaphore(1)
+# ServerAdapter of the running server
+SERVER_ADAPTER = None
+# Send the whole content when new blocks make up more than this ratio of it
+PATCH_MAX_RATIO = 0.5
+# Don't bother compressing smaller responses
+COMPRESS_MIN_SIZE = 1024
+LINE_RE = re.compile(r'[^\n]*\n|[^\n]+$')
+# Send the whole content when more lines than this are left to diff, past the
+# lines in common at both ends (diffing is quadratic at worst)
+DELTA_MAX_LINES = 2000
 
 
 def init():
     global USER_STATIC_FILES_DIR
     global USER_TEMPLATE_FILES_DIR
+    global THUMBNAIL_CACHE_DIR
 
     USER_STATIC_FILES_DIR = os.path.normpath(os.path.join(sublime.packages_path(),
                                              'User', 'OmniMarkupPreviewer', 'public'))
@@ -76,6 +105,16 @@ def init():
 
     mk_folders([USER_STATIC_FILES_DIR, USER_TEMPLATE_FILES_DIR])
     bottle.TEMPLATE_PATH = [USER_TEMPLATE_FILES_DIR, DEFAULT_TEMPLATE_FILES_DIR]
+    PRECOMPRESSED.configure(DEFAULT_STATIC_FILES_DIR,
+                            os.path.join(sublime.packages_path(), 'User', 'OmniMarkupPreviewer',
+                                         'cache', 'public'))
+    THUMBNAIL_CACHE_DIR = os.path.join(sublime.packages_path(), 'User', 'OmniMarkupPreviewer',
+                                       'cache', 'thumbnails')
+
+
+def configure_image_proxy(setting):
+    IMAGE_PROXY.configure(THUMBNAIL_CACHE_DIR, setting.image_proxy_max_width,
+                          setting.image_proxy_command, setting.image_proxy_cache_max_bytes)
 
 
 # Create a new app stack
@@ -83,9 +122,13 @@ app = Bottle()
 
 
 def get_static_public_file(filepath):
-    if os.path.exists(os.path.join(USER_STATIC_FILES_DIR, filepath)):
-        return static_file(filepath, root=USER_STATIC_FILES_DIR)
-    return static_file(filepath, root=DEFAULT_STATIC_FILES_DIR)
+    user_path = safe_join(USER_STATIC_FILES_DIR, filepath)
+    if user_path is not None and STAT_CACHE.stat(user_path) is not None:
+        return serve_file(user_path)
+    path = safe_join(DEFAULT_STATIC_FILES_DIR, filepath)
+    if path is None:
+        return bottle.HTTPError(403, "Access denied.")
+    return serve_file(path, public_cache_control(filepath))
 
 
 @app.route('/public/<filepath:path>')
@@ -100,38 +143,180 @@ def handler_local(base64_encoded_path):
     """Serving local files."""
     fullpath = base64.urlsafe_b64decode(base64_encoded_path).decode('utf-8')
     fullpath = unquote(fullpath)
-    basename = os.path.basename(fullpath)
-    dirname = os.path.dirname(fullpath)
-    return static_file(basename, root=dirname)
+    if 'original' not in request.query:
+        thumbnail = IMAGE_PROXY.get(fullpath)
+        if thumbnail is not None:
+            mimetype = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
+            return serve_file(thumbnail, mimetype=mimetype)
+    return serve_file(fullpath)
+
+
+def make_patch(old_entry, entry):
+    """Make a block-level patch updating `old_entry` to `entry`.
+
+    The patch lists blocks of `entry` in order, as the block id for blocks
+    already in `old_entry`, or as {id, html} for new ones. Returns None if the
+    whole content should be sent instead.
+    """
+    if old_entry.blocks is None or entry.blocks is None:
+        return None
+    old_block_ids = set(block_id for block_id, _ in old_entry.blocks)
+    patch = []
+    new_size = 0
+    for block_id, html in entry.blocks:
+        if block_id in old_block_ids:
+            patch.append(block_id)
+        else:
+            patch.append({'id': block_id, 'html': html})
+            new_size += len(html)
+    if new_size > len(entry.html_part) * PATCH_MAX_RATIO:
+        return None
+    return patch
+
+
+def make_delta(old_text, text):
+    """Make a line-based delta from `old_text` to `text`.
+
+    The delta is a list of [start, end] line ranges to copy from `old_text`,
+    and strings to insert. Returns None if it wouldn't be much smaller, or
+    would take too long to compute.
+    """
+    old_lines = LINE_RE.findall(old_text)
+    lines = LINE_RE.findall(text)
+    # Edits usually leave most lines at both ends alone, only diff the rest
+    common = min(len(old_lines), len(lines))
+    prefix = 0
+    while prefix < common and old_lines[prefix] == lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < common - prefix and old_lines[-1 - suffix] == lines[-1 - suffix]:
+        suffix += 1
+    old_end = len(old_lines) - suffix
+    end = len(lines) - suffix
+    if max(old_end, end) - prefix > DELTA_MAX_LINES:
+        return None
+    delta = []
+    if prefix:
+        delta.append([0, prefix])
+    inserted_size = 0
+    matcher = difflib.SequenceMatcher(None, old_lines[prefix:old_end], lines[prefix:end])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append([prefix + i1, prefix + i2])
+        elif j1 < j2:
+            inserted = ''.join(lines[prefix + j1:prefix + j2])
+            delta.append(inserted)
+            inserted_size += len(inserted)
+    if suffix:
+        delta.append([old_end, len(old_lines)])
+    if inserted_size > len(text) * PATCH_MAX_RATIO:
+        return None
+    return delta
+
+
+def compressed_json(result):
+    """Encode `result` as JSON, compressed if the client accepts it."""
+    body = json.dumps(result).encode('utf-8')
+    response.content_type = 'application/json'
+    response.set_header('Vary', 'Accept-Encoding')
+    if len(body) < COMPRESS_MIN_SIZE:
+        return body
+    accept_encoding = request.headers.get('Accept-Encoding', '')
+    encodings = [e.split(';')[0].strip().lower() for e in accept_encoding.split(',')]
+    if 'gzip' in encodings:
+        # wbits=31 for gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        body = compressor.compress(body) + compressor.flush()
+        response.set_header('Content-Encoding', 'gzip')
+    elif 'deflate' in encodings:
+        body = zlib.compress(body, 6)
+        response.set_header('Content-Encoding', 'deflate')
+    return body
 
 
 @app.post('/api/query')
 def handler_api_query():
-    """Querying for updates."""
+    """Querying for updates.
+
+    With `wait` set in the request, blocks until the buffer gets updated, or
+    `long_polling_timeout` elapses. `long_polling` in the response tells the
+    client whether to query again immediately. Clients with `patchable` set
+    may get a PATCH (see make_patch()) instead of the whole content, and
+    clients holding the HTML of the `delta_base` version a DELTA (see
+    make_delta()).
+    """
     entry = None
     try:
         obj = request.json
         buffer_id = obj['buffer_id']
         timestamp = str(obj['timestamp'])
+        wait = obj.get('wait', False)
+        patchable = obj.get('patchable', False)
+        delta_base = obj.get('delta_base')
         entry = RenderedMarkupCache.instance().get_entry(buffer_id)
     except:
         return None
 
+    long_polling_timeout = Setting.instance().long_polling_timeout
+    long_polling = long_polling_timeout > 0
+    if (wait and long_polling and entry is not None and not entry.disconnected and
+            entry.timestamp == timestamp):
+        if LONG_POLLING_SLOTS.acquire(False):
+            try:
+                entry = RenderedMarkupCache.instance().wait_entry(
+                    buffer_id, timestamp, long_polling_timeout)
+            finally:
+                LONG_POLLING_SLOTS.release()
+        else:
+            # All slots taken, let the client fall back to polling periodically
+            long_polling = False
+
     if entry is None or entry.disconnected:
-        return {'status': 'DISCONNECTED'}
+        return compressed_json({'status': 'DISCONNECTED'})
 
     if entry.timestamp == timestamp:  # Keep old entry
-        return {'status': 'UNCHANGED'}
+        return compressed_json({'status': 'UNCHANGED', 'long_polling': long_polling})
 
     result = {
         'status': 'OK',
+        'long_polling': long_polling,
         'timestamp': entry.timestamp,
         'revivable_key': entry.revivable_key,
         'filename': entry.filename,
         'dirname': entry.dirname,
-        'html_part': entry.html_part
     }
-    return result
+
+    patch = None
+    if patchable:
+        old_entry = RenderedMarkupCache.instance().get_entry_version(buffer_id, timestamp)
+        if old_entry is not None:
+            patch = make_patch(old_entry, entry)
+    if patch is not None:
+        result['status'] = 'PATCH'
+        result['blocks'] = patch
+        return compressed_json(result)
+
+    delta = None
+    if delta_base is not None:
+        old_entry = RenderedMarkupCache.instance().get_entry_version(buffer_id, str(delta_base))
+        if old_entry is not None:
+            delta = make_delta(old_entry.html_part, entry.html_part)
+    if delta is not None:
+        result['status'] = 'DELTA'
+        result['delta'] = delta
+    else:
+        result['html_part'] = entry.html_part
+    if entry.blocks is not None:
+        result['block_ids'] = [block_id for block_id, _ in entry.blocks]
+    return compressed_json(result)
+
+
+@app.route('/api/stats')
+def handler_api_stats():
+    """Server statistics."""
+    if SERVER_ADAPTER is None:
+        return {}
+    return SERVER_ADAPTER.get_stats()
 
 
 @app.post('/api/revive')
@@ -182,6 +367,119 @@ the `server_port` option in order to get this plugin work again."""
                     **entry)
 
 
+class ElasticThreadPool(wsgiserver.ThreadPool):
+    """Thread pool growing on demand, up to `max` threads.
+
+    Threads above `min` are stopped when some of them have been idle for
+    `idle_timeout` seconds. Also keeps request queue statistics.
+    """
+
+    def __init__(self, server, min=4, max=16, idle_timeout=60):
+        wsgiserver.ThreadPool.__init__(self, server, min=min, max=max)
+        self.idle_timeout = idle_timeout
+        self.get = self._get
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.monitor = None
+        self.stats = {
+            'requests': 0,
+            'max_queue_depth': 0,
+            'total_queue_time': 0.0,
+            'max_queue_time': 0.0,
+            'threads_grown': 0,
+            'threads_shrunk': 0,
+        }
+
+    def _get_idle(self):
+        with self.lock:
+            return len([t for t in self._threads if t.conn is None and t.is_alive()])
+    idle = property(_get_idle)
+
+    def start(self):
+        wsgiserver.ThreadPool.start(self)
+        self.stopping.clear()
+        self.monitor = threading.Thread(target=self._monitor)
+        self.monitor.daemon = True
+        self.monitor.start()
+
+    def put(self, conn):
+        conn.queued_time = time()
+        self._queue.put(conn)
+        with self.lock:
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'],
+                                                self._queue.qsize())
+        # Requests would wait in the queue otherwise
+        if self.idle == 0:
+            self.grow(1)
+
+    def _get(self):
+        conn = self._queue.get()
+        queued_time = getattr(conn, 'queued_time', None)
+        if queued_time is not None:
+            elapsed = time() - queued_time
+            with self.lock:
+                self.stats['requests'] += 1
+                self.stats['total_queue_time'] += elapsed
+                self.stats['max_queue_time'] = max(self.stats['max_queue_time'], elapsed)
+        return conn
+
+    def grow(self, amount):
+        # Unlike ThreadPool.grow(), don't wait for new threads to be ready,
+        # it's called from the thread accepting connections
+        with self.lock:
+            budget = max(self.max - len(self._threads), 0)
+            for i in range(min(amount, budget)):
+                self._threads.append(self._spawn_worker())
+                self.stats['threads_grown'] += 1
+
+    def shrink(self, amount):
+        with self.lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            amount = min(amount, max(len(self._threads) - self.min, 0))
+            for i in range(amount):
+                # Picked up by idle threads, which then exit
+                self._queue.put(_SHUTDOWNREQUEST)
+            self.stats['threads_shrunk'] += amount
+
+    def _monitor(self):
+        # Shrink by the least number of idle threads seen over `idle_timeout`
+        window_start = time()
+        min_idle = None
+        while not self.stopping.is_set():
+            self.stopping.wait(min(1.0, self.idle_timeout))
+            idle = self.idle
+            if min_idle is None or idle < min_idle:
+                min_idle = idle
+            if time() - window_start >= self.idle_timeout:
+                if min_idle > 0:
+                    self.shrink(min_idle)
+                window_start = time()
+                min_idle = None
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        wsgiserver.ThreadPool.stop(self, timeout)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            threads = len([t for t in self._threads if t.is_alive()])
+        stats.update({
+            'threads': threads,
+            'idle_threads': self.idle,
+            'min_threads': self.min,
+            'max_threads': self.max,
+            'queue_depth': self._queue.qsize(),
+            'avg_queue_time': stats['total_queue_time'] / (stats['requests'] or 1),
+        })
+        del stats['total_queue_time']
+        return stats
+
+
+# Not exported by wsgiserver
+_SHUTDOWNREQUEST = sys.modules[wsgiserver.ThreadPool.__module__]._SHUTDOWNREQUEST
+
+
 class StoppableCherryPyServer(ServerAdapter):
     """HACK for making a stoppable server"""
 
@@ -190,11 +488,30 @@ class StoppableCherryPyServer(ServerAdapter):
         self.srv = None
 
     def run(self, handler):
+        global LONG_POLLING_SLOTS
+
+        min_threads = max(1, self.options.get('min_threads', 4))
+        max_threads = max(min_threads, self.options.get('max_threads', 16))
         self.srv = wsgiserver.CherryPyWSGIServer(
-            (self.host, self.port), handler, numthreads=2, timeout=2, shutdown_timeout=2
+            (self.host, self.port), handler, timeout=2, shutdown_timeout=2,
+            # Browsers open several connections at once, don't let them wait
+            # for SYN retransmissions
+            request_queue_size=64
         )
+        self.srv.requests = ElasticThreadPool(
+            self.srv, min=min_threads, max=max_threads,
+            idle_timeout=max(1, self.options.get('thread_idle_timeout', 60)))
+        LONG_POLLING_SLOTS = threading.Semaphore(max(1, max_threads - 1))
         self.srv.start()
 
+    def get_stats(self):
+        srv = getattr(self, 'srv', None)
+        if srv is None:
+            return {}
+        stats = srv.requests.get_stats()
+        stats['backend'] = 'cherrypy'
+        return stats
+
     def shutdown(self):
         try:
             if self.srv is not None:
@@ -222,13 +539,31 @@ class Server(object):
         def run(self):
             bottle_run(server=self.server)
 
-    def __init__(self, host='127.0.0.1', port='51004'):
-        self.server = StoppableCherryPyServer(host=host, port=port)
+    def __init__(self, host='127.0.0.1', port='51004', backend='cherrypy', **options):
+        global SERVER_ADAPTER
+
+        self.server = None
+        if backend == 'asyncio':
+            try:
+                # Requires python 3.5+
+                from .AsyncioServer import AsyncioServer
+            except (ImportError, SyntaxError) as err:
+                log.error('asyncio server backend unavailable (%s), using cherrypy', err)
+            else:
+                self.server = AsyncioServer(host=host, port=port, **options)
+        if self.server is None:
+            self.server = StoppableCherryPyServer(host=host, port=port, **options)
+        SERVER_ADAPTER = self.server
+        # gzip bundled static files not compressed yet
+        PRECOMPRESSED.start()
         self.runner = Server.ServerThread(self.server)
         self.runner.daemon = True
         self.runner.start()
 
     def stop(self):
         log.info('Bottle server shuting down...')
+        PRECOMPRESSED.stop()
+        # Release threads held by long polling requests
+        RenderedMarkupCache.instance().wake_all()
         self.server.shutdown()
         self.runner.join()
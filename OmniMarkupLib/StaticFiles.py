@@ -0,0 +1,344 @@
+"""
+Copyright (c) 2013 Timon Wong
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import mimetypes
+import mmap
+import os
+import re
+import stat
+import tempfile
+import threading
+import time
+import zlib
+
+from . import log
+from .RenderCache import LRUCache, replace_file
+
+from bottle import HTTPError, HTTPResponse, parse_date, request, static_file
+
+# Bundled assets with the version in their names never change
+VERSIONED_ASSET_RE = re.compile(r'-\d+(\.\d+)+(\.min)?\.(js|css|map)$')
+CACHE_CONTROL_VERSIONED = 'public, max-age=31536000'
+# Vendored MathJax (2.1), only changes with plugin updates
+CACHE_CONTROL_VENDOR = 'public, max-age=604800'
+# Revalidate every time (cheap with ETags)
+CACHE_CONTROL_DEFAULT = 'no-cache'
+# Content types served with "; charset=UTF-8", as bottle does for text
+CHARSET_MIMETYPES = ('text/', 'application/javascript')
+# Files worth keeping gzip'ed copies of (woff and images are compressed already)
+COMPRESSIBLE_RE = re.compile(r'\.(css|eot|htm|html|js|json|map|otf|svg|ttf|txt|xml)$', re.I)
+COMPRESS_MIN_SIZE = 1024
+# Files up to this size are kept in memory, larger ones are memory-mapped
+MEMORY_CACHE_MAX_FILE_SIZE = 256 * 1024
+MEMORY_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+
+class StatCache(object):
+    """Caches os.stat() results (None for missing files) for `ttl` seconds."""
+
+    def __init__(self, ttl=2.0, max_entries=4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def stat(self, path):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+            self.entries[path] = (now + self.ttl, st)
+        return st
+
+    def invalidate(self, path=None):
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(path, None)
+
+
+STAT_CACHE = StatCache()
+
+
+class PrecompressedFiles(object):
+    """gzip'ed copies of the compressible files under `root`, kept in `cache_dir`.
+
+    Copies are made by a background thread, and have the mtime of their
+    source file, so outdated ones are never served.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.cache_dir = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def configure(self, root, cache_dir):
+        self.root = os.path.abspath(root) + os.sep
+        self.cache_dir = cache_dir
+
+    def compressible(self, path):
+        return (self.root is not None and path.startswith(self.root) and
+                COMPRESSIBLE_RE.search(path) is not None)
+
+    def get_compressed_path(self, path):
+        return os.path.join(self.cache_dir, path[len(self.root):]) + '.gz'
+
+    def get(self, path, st):
+        """Get the path of the up to date gzip'ed copy of `path`, or None."""
+        if not self.compressible(path):
+            return None
+        gz_st = STAT_CACHE.stat(self.get_compressed_path(path))
+        if gz_st is None or int(gz_st.st_mtime) != int(st.st_mtime):
+            return None
+        return self.get_compressed_path(path)
+
+    def start(self):
+        if self.root is None:
+            return
+        if self.thread is not None and self.thread.is_alive():
+            if not self.stopping.is_set():
+                return
+            # Stops after the file being compressed
+            self.thread.join()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def _run(self):
+        start = time.time()
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if self.stopping.is_set():
+                    return
+                path = os.path.join(dirpath, filename)
+                try:
+                    if self._compress(path):
+                        count += 1
+                except (IOError, OSError) as err:
+                    log.error('Unable to compress %s: %s', path, err)
+                # Leave the CPU to previews
+                time.sleep(0)
+        if count:
+            log.info('Compressed %d static files in %.2fs', count, time.time() - start)
+
+    def _compress(self, path):
+        if not self.compressible(path):
+            return False
+        st = os.stat(path)
+        if st.st_size < COMPRESS_MIN_SIZE:
+            return False
+        gz_path = self.get_compressed_path(path)
+        try:
+            if int(os.stat(gz_path).st_mtime) == int(st.st_mtime):
+                return False
+        except OSError:
+            pass
+        gz_dir = os.path.dirname(gz_path)
+        if not os.path.isdir(gz_dir):
+            os.makedirs(gz_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=gz_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # wbits=31 for gzip header and trailer
+                compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+                with open(path, 'rb') as source:
+                    for chunk in iter(lambda: source.read(65536), b''):
+                        f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+            os.utime(tmp_path, (st.st_atime, st.st_mtime))
+            replace_file(tmp_path, gz_path)
+        except:
+            os.remove(tmp_path)
+            raise
+        STAT_CACHE.invalidate(gz_path)
+        return True
+
+
+PRECOMPRESSED = PrecompressedFiles()
+
+
+class FileContentCache(object):
+    """Contents of small files, validated by the ETag of the file."""
+
+    def __init__(self, max_bytes=MEMORY_CACHE_MAX_BYTES):
+        self.cache = LRUCache(max_bytes, sizeof=lambda value: len(value[1]))
+
+    def get(self, path, etag):
+        value = self.cache.get(path)
+        if value is not None and value[0] == etag:
+            return value[1]
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.cache.set(path, (etag, data))
+        return data
+
+    def clear(self):
+        self.cache.clear()
+
+
+FILE_CONTENT_CACHE = FileContentCache()
+
+
+def open_file_body(path, st, etag):
+    """Get the content of a file as a response body.
+
+    Small files come from FILE_CONTENT_CACHE, larger ones are memory-mapped,
+    so they are served from the page cache without read() calls, and
+    unmapped when the response is closed.
+    """
+    if st.st_size <= MEMORY_CACHE_MAX_FILE_SIZE:
+        return FILE_CONTENT_CACHE.get(path, etag)
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def safe_join(root, filepath):
+    """Join `filepath` to `root`, returns None if it's outside of `root`."""
+    root = os.path.abspath(root) + os.sep
+    path = os.path.abspath(os.path.join(root, filepath.strip('/\\')))
+    if not path.startswith(root):
+        return None
+    return path
+
+
+def make_etag(st):
+    """Strong ETag from the size, mtime and inode of a file."""
+    return '"%x-%x-%x"' % (st.st_size, int(st.st_mtime * 1000000), st.st_ino)
+
+
+def accepts_encoding(encoding):
+    for value in request.environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = value.strip().split(';')
+        if params[0].strip().lower() != encoding:
+            continue
+        for param in params[1:]:
+            name, _, q = param.partition('=')
+            if name.strip() == 'q' and q.strip() in ('0', '0.0', '0.00', '0.000'):
+                return False
+        return True
+    return False
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in if_none_match.split(',')]
+
+
+def public_cache_control(filepath):
+    """Cache-Control for bundled files under public/."""
+    filepath = filepath.replace('\\', '/')
+    if VERSIONED_ASSET_RE.search(filepath):
+        return CACHE_CONTROL_VERSIONED
+    if filepath.startswith('mathjax/'):
+        return CACHE_CONTROL_VENDOR
+    return CACHE_CONTROL_DEFAULT
+
+
+def serve_file(path, cache_control=CACHE_CONTROL_DEFAULT, mimetype=None):
+    """Serve the file at `path` with ETag and Cache-Control headers.
+
+    Answers conditional requests with 304 from cached stats only, and serves
+    the gzip'ed copy from PRECOMPRESSED if there's one and the client accepts
+    it. Contents come from open_file_body(), except for range requests.
+    `mimetype` is guessed from `path` if not given.
+    """
+    st = STAT_CACHE.stat(path)
+    if st is None or not stat.S_ISREG(st.st_mode):
+        return HTTPError(404, "File does not exist.")
+    etag = make_etag(st)
+    headers = {'Cache-Control': cache_control}
+    gz_path = None
+    if PRECOMPRESSED.compressible(path):
+        headers['Vary'] = 'Accept-Encoding'
+        if accepts_encoding('gzip') and 'HTTP_RANGE' not in request.environ:
+            gz_path = PRECOMPRESSED.get(path, st)
+            gz_st = gz_path and STAT_CACHE.stat(gz_path)
+            if gz_st is not None:
+                etag = etag[:-1] + '-gz"'
+            else:
+                gz_path = None
+    headers['ETag'] = etag
+    headers['Last-Modified'] = time.strftime("%a, %d %b %Y %H:%M:%S GMT",
+                                             time.gmtime(st.st_mtime))
+    if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        not_modified = etag_matches(if_none_match, etag)
+    else:
+        ims = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+        ims = ims and parse_date(ims.split(";")[0].strip())
+        not_modified = ims is not None and ims >= int(st.st_mtime)
+    if not_modified:
+        headers['Date'] = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+        return HTTPResponse(status=304, **headers)
+
+    if mimetype is None:
+        mimetype, encoding = mimetypes.guess_type(path)
+    else:
+        encoding = None
+    if mimetype and mimetype.startswith(CHARSET_MIMETYPES) and 'charset' not in mimetype:
+        mimetype += '; charset=UTF-8'
+
+    if 'HTTP_RANGE' in request.environ:
+        # Let bottle handle partial content
+        response = static_file(os.path.basename(path), root=os.path.dirname(path),
+                               mimetype=mimetype or 'auto')
+        if response.status_code in (200, 206):
+            for name, value in headers.items():
+                response.set_header(name, value)
+        return response
+
+    headers['Content-Type'] = mimetype or 'application/octet-stream'
+    if gz_path is not None:
+        encoding = 'gzip'
+        path = gz_path
+        st = gz_st
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    headers['Accept-Ranges'] = 'bytes'
+    if request.method == 'HEAD':
+        headers['Content-Length'] = str(st.st_size)
+        return HTTPResponse('', **headers)
+    try:
+        body = open_file_body(path, st, etag)
+    except (IOError, OSError, ValueError):
+        return HTTPError(403, "You do not have permission to access this file.")
+    # The file may have changed since it was stat'ed
+    headers['Content-Length'] = str(len(body))
+    return HTTPResponse(body, **headers)
@@ -129,6 +129,15 @@ class OmniMarkupCleanCacheCommand(sublime_plugin.ApplicationCommand):
     def run(self):
         storage = RenderedMarkupCache.instance()
         storage.clean()
+        stats = RendererManager.RENDER_CACHE.stats()
+        log.info('Render cache: %d hits, %d misses, %d entries (%d bytes)',
+                 stats['hits'], stats['misses'], stats['entries'], stats['size'])
+        RendererManager.RENDER_CACHE.clear()
+        RendererManager.DISK_CACHE.clear()
+        RendererManager.EMBEDDED_IMAGES_CACHE.clear()
+        Server.STAT_CACHE.invalidate()
+        Server.FILE_CONTENT_CACHE.clear()
+        Server.IMAGE_PROXY.cache.clear()
 
 
 class OmniMarkupExportCommand(sublime_plugin.TextCommand):
@@ -136,7 +145,7 @@ class OmniMarkupExportCommand(sublime_plugin.TextCommand):
         sublime.set_clipboard(html_content)
         sublime.status_message('Exported result copied to clipboard')
 
-    def write_to_file(self, html_content, setting):
+    def write_to_file(self, html_chunks, setting):
         target_folder = setting.export_options.get('target_folder', '.')
 
         if target_folder is not None:
@@ -161,26 +170,39 @@ class OmniMarkupExportCommand(sublime_plugin.TextCommand):
             with tempfile.NamedTemporaryFile(delete=False, suffix='.html') as f:
                 html_fn = f.name
 
-        with codecs.open(html_fn, 'w', encoding='utf-8') as html_file:
-            html_file.write(html_content)
-            log.info('Successfully exported to: %s', html_fn)
+        try:
+            with codecs.open(html_fn, 'w', encoding='utf-8') as html_file:
+                for chunk in html_chunks:
+                    html_file.write(chunk)
+        except:
+            # Don't leave a truncated export behind
+            if os.path.exists(html_fn):
+                os.remove(html_fn)
+            raise
+        log.info('Successfully exported to: %s', html_fn)
 
         return html_fn
 
     def run(self, edit, clipboard_only=False):
         view = self.view
         try:
-            html_content = RendererManager.render_view_as_html(view)
+            setting = Setting.instance()
+            if clipboard_only or setting.export_options.get('copy_to_clipboard', False):
+                html_content = RendererManager.render_view_as_html(view)
+                html_chunks = [html_content]
+            else:
+                # Streamed to the file, without building the whole page in memory
+                html_content = None
+                html_chunks = RendererManager.render_view_as_html_chunks(view)
 
             if clipboard_only:
                 self.copy_to_clipboard(html_content)
                 return
 
-            setting = Setting.instance()
-            html_fn = self.write_to_file(html_content, setting)
+            html_fn = self.write_to_file(html_chunks, setting)
 
             # Copy contents to clipboard
-            if setting.export_options.get('copy_to_clipboard', False):
+            if html_content is not None:
                 self.copy_to_clipboard(html_content)
 
             # Open output file if necessary
@@ -307,10 +329,7 @@ class PluginEventListener(sublime_plugin.EventListener):
         return None
 
     def _on_close(self, view):
-        storage = RenderedMarkupCache.instance()
-        entry = storage.get_entry(view.buffer_id())
-        if entry is not None:
-            entry.disconnected = True
+        RenderedMarkupCache.instance().disconnect(view.buffer_id())
 
     def _on_modified(self, view):
         # Prevent rare complaintion about slow callback
@@ -351,6 +370,8 @@ class PluginManager(object):
     def on_setting_changing(self, setting):
         self.old_server_host = setting.server_host
         self.old_server_port = setting.server_port
+        self.old_server_options = (setting.server_backend, setting.server_min_threads,
+                                   setting.server_max_threads, setting.server_thread_idle_timeout)
         self.old_ajax_polling_interval = setting.ajax_polling_interval
         self.old_html_template_name = setting.html_template_name
 
@@ -359,10 +380,14 @@ class PluginManager(object):
                 setting.html_template_name != self.old_html_template_name):
             sublime.status_message('OmniMarkupPreviewer requires a browser reload to apply changes')
 
+        server_options = (setting.server_backend, setting.server_min_threads,
+                          setting.server_max_threads, setting.server_thread_idle_timeout)
         need_server_restart = (setting.server_host != self.old_server_host or
-                               setting.server_port != self.old_server_port)
+                               setting.server_port != self.old_server_port or
+                               server_options != self.old_server_options)
         if need_server_restart:
             self.restart_server()
+        Server.configure_image_proxy(setting)
 
     def subscribe_setting_events(self):
         Setting.instance().subscribe('changing', self.on_setting_changing)
@@ -373,7 +398,11 @@ class PluginManager(object):
         if g_server is not None:
             self.stop_server()
         setting = Setting.instance()
-        g_server = Server.Server(host=setting.server_host, port=setting.server_port)
+        g_server = Server.Server(host=setting.server_host, port=setting.server_port,
+                                 backend=setting.server_backend,
+                                 min_threads=setting.server_min_threads,
+                                 max_threads=setting.server_max_threads,
+                                 thread_idle_timeout=setting.server_thread_idle_timeout)
 
     def stop_server(self):
         global g_server
@@ -395,6 +424,7 @@ def plugin_loaded():
     # Setting must be the first to initialize.
     Setting.instance().init()
     PluginManager.instance().subscribe_setting_events()
+    Server.configure_image_proxy(Setting.instance())
     RendererManager.start()
     PluginManager.instance().restart_server()
 
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Check and benchmark incremental rendering.
+
+Renders documents known to be tricky to split (raw HTML and comments with
+blank lines inside, definition lists, open code fences, prose looking like
+reference definitions, sections with clashing ids...) and the given files
+both as a whole and incrementally, and checks that the results are the same. For the given files, also times re-rendering after an edit to their
+last block.
+
+Usage: python benchmarks/incremental_render.py [markdown or reStructuredText files...]
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import timeit
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+LIBS = os.path.join(ROOT, 'OmniMarkupLib', 'Renderers', 'libs')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, LIBS)
+sys.path.insert(0, os.path.join(LIBS, 'python3' if sys.version_info >= (3, 0, 0) else 'python2'))
+
+from OmniMarkupLib.Renderers.MarkdownRenderer import MarkdownRenderer
+from OmniMarkupLib.Renderers.RstRenderer import RstRenderer
+
+MARKDOWN_OPTIONS = [
+    {'extensions': ['tables', 'strikeout', 'fenced_code', 'codehilite']},
+    {'extensions': ['extra', 'codehilite']},
+]
+MARKDOWN_CASES = [
+    u'para\n\n<div>\n\nhello\n\n</div>\n\nafter *x*\n',
+    u'<!--\n\ncomment\n\n-->\n\ntext\n',
+    u'<div>\n\n<div>\nx\n</div>\n\n</div>\n\ny\n',
+    u'<div>\n[a]: http://example.com/\n</div>\n\n[link][a]\n',
+    u'<div>x</div> tail\n\nmore\n',
+    u'<span>inline</span>\n\nnext\n',
+    u'<div>\n\n```\n</div>\n```\n\n</div>\n\nz\n',
+    u'term\n: def\n\nterm2\n: def2\n\npara\n',
+    u'term\n\n: def\n\nterm2\n: def2\n',
+    u'term1\nterm2\n: def\n\nterm3\n: def3\n',
+    u'Intro.\n\n[Note]: this is a note about things.\n\nOther para.\n\nThird para.\n',
+    u'[a]: http://example.com/\n"Title"\n\n[b]: http://example.com/ "Title"\n"Not a title"\n\n[x][a] [y][b]\n',
+    u'See [a].\n\n```\ncode\n\n[a]: http://example.com/\n\n*abbr*\n',
+    u'```python\ncode\n\n```\n\n[x][a]\n\n```\nopen\n\n[a]: http://example.com/\n',
+    u'```\n[a]: http://example.com/\n```\n\n[x][a]\n\ntext\n',
+]
+RST_CASES = [
+    u'A.B\n===\n\nx\n\nA B\n===\n\ny\n',
+    u'Usage\n=====\n\nx\n\nUsage\n=====\n\ny\n',
+    u'.. _usage:\n\nUsage\n=====\n\nx\n\nOther\n=====\n\n.. _usage2:\n\nUsage2\n======\n\ny\n',
+    u'Intro\n=====\n\n.. _a-b:\n\npara\n\nA B\n===\n\nx\n',
+    u'Intro\n=====\n\nSee `A B`_.\n\nA B\n===\n\nx\n',
+]
+
+
+class GlobalSetting(object):
+    mathjax_enabled = False
+
+
+def normalize(html):
+    # Blocks are joined with a single newline
+    return re.sub(r'\n+', '\n', html)
+
+
+def render(renderer, text, incremental):
+    renderer.incremental = incremental
+    return renderer.render(text, filename='document', fullpath='document')
+
+
+def check(renderer, name, text):
+    full = render(renderer, text, False)
+    incremental = render(renderer, text, True)
+    if normalize(full) != normalize(incremental):
+        print('MISMATCH %s\n--- full\n%s\n--- incremental\n%s' % (name, full, incremental))
+        return False
+    return True
+
+
+def bench(renderer, name, text, number):
+    edits = [text + u'\n\nedit %d\n' % i for i in range(number)]
+    render(renderer, text, True)
+    t_full = min(timeit.repeat(lambda: render(renderer, text, False), number=number,
+                               repeat=3)) / number
+    t_incremental = min(timeit.repeat(lambda: [render(renderer, edit, True) for edit in edits],
+                                      number=1, repeat=3)) / number
+    print('%-32s full %8.3f ms  incremental %8.3f ms' % (
+        name, t_full * 1000, t_incremental * 1000))
+
+
+def main(filenames):
+    markdown_documents = [('<markdown case %d>' % i, text) for i, text in enumerate(MARKDOWN_CASES)]
+    rst_documents = [('<rst case %d>' % i, text) for i, text in enumerate(RST_CASES)]
+    files = []
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            document = (os.path.basename(filename), f.read().decode('utf-8'))
+        if RstRenderer.is_enabled(filename, ''):
+            rst_documents.append(document)
+            files.append((RstRenderer, {}, document))
+        else:
+            markdown_documents.append(document)
+            files.append((MarkdownRenderer, {}, document))
+    runs = [(MarkdownRenderer, options, markdown_documents) for options in MARKDOWN_OPTIONS]
+    runs.append((RstRenderer, {}, rst_documents))
+    checked = failures = 0
+    for renderer_class, options, documents in runs:
+        renderer = renderer_class()
+        renderer.load_settings(options, GlobalSetting())
+        for name, text in documents:
+            checked += 1
+            if not check(renderer, '%s %s' % (name, options), text):
+                failures += 1
+    print('%d documents checked, %d mismatches' % (checked, failures))
+    for renderer_class, options, (name, text) in files:
+        renderer = renderer_class()
+        renderer.load_settings(options, GlobalSetting())
+        bench(renderer, name, text, 10)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Micro-benchmark for the per-render setup overhead of MarkdownRenderer.
+
+Compares the `markdown.markdown()` shortcut, which builds a new `Markdown`
+instance (and loads every extension) for each call, against a single instance
+reused with `reset()` between documents.
+
+Usage: python benchmarks/markdown_engine.py [markdown files...]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+LIBS = os.path.join(ROOT, 'OmniMarkupLib', 'Renderers', 'libs')
+sys.path.insert(0, LIBS)
+sys.path.insert(0, os.path.join(LIBS, 'python3' if sys.version_info >= (3, 0, 0) else 'python2'))
+
+import markdown
+
+EXTENSIONS = ['codehilite(linenums=False,guess_lang=False)', 'fenced_code',
+              'mathjax', 'strikeout', 'tables']
+SMALL_DOC = u'# Title\n\nSome *text* with `code`.\n\n```python\nprint(1)\n```\n'
+
+
+def bench(name, text, number):
+    def shortcut():
+        markdown.markdown(text, output_format='html5', extensions=EXTENSIONS)
+
+    md = markdown.Markdown(output_format='html5', extensions=EXTENSIONS)
+
+    def reused():
+        md.reset()
+        md.convert(text)
+
+    assert markdown.markdown(text, output_format='html5', extensions=EXTENSIONS) == \
+        md.reset().convert(text)
+    t_shortcut = min(timeit.repeat(shortcut, number=number, repeat=5)) / number
+    t_reused = min(timeit.repeat(reused, number=number, repeat=5)) / number
+    print('%-32s shortcut %8.3f ms  reused %8.3f ms  saved %8.3f ms/render' % (
+        name, t_shortcut * 1000, t_reused * 1000, (t_shortcut - t_reused) * 1000))
+
+
+def main(filenames):
+    bench('<empty>', u'', 200)
+    bench('<small>', SMALL_DOC, 200)
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            text = f.read().decode('utf-8')
+        bench(os.path.basename(filename), text, 20)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or [os.path.join(ROOT, 'README.md'), os.path.join(ROOT, 'CHANGELOG.md')])
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Load test for the preview server.
+
+Simulates N preview clients against a running preview server (Sublime Text
+with this plugin loaded): each client loads the preview page with its
+static files, then keeps polling `/api/query`, reloading static files every
+few polls like MathJax does while typesetting. Reports p50/p99 latencies per
+request kind, and the server's thread pool statistics.
+
+Usage: python benchmarks/preview_load.py BUFFER_ID [options]
+
+The buffer id is the number in the preview URL (http://127.0.0.1:51004/view/<id>).
+"""
+
+from __future__ import print_function
+
+import json
+import optparse
+import sys
+import threading
+import time
+
+try:
+    from urllib.request import urlopen, Request
+except ImportError:
+    from urllib2 import urlopen, Request
+
+STATIC_FILES = ['/public/app.js', '/public/jquery-2.1.3.min.js',
+                '/public/imagesloaded.pkgd.min.js', '/public/github.css']
+
+
+class Client(threading.Thread):
+    def __init__(self, base_url, buffer_id, deadline, static_every):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.base_url = base_url
+        self.buffer_id = buffer_id
+        self.deadline = deadline
+        self.static_every = static_every
+        self.latencies = {}
+        self.errors = 0
+
+    def fetch(self, kind, path, data=None):
+        headers = {'Accept-Encoding': 'gzip'}
+        if data is not None:
+            data = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        start = time.time()
+        try:
+            body = urlopen(Request(self.base_url + path, data, headers), timeout=60).read()
+        except Exception:
+            self.errors += 1
+            return None
+        self.latencies.setdefault(kind, []).append(time.time() - start)
+        return body
+
+    def run(self):
+        self.fetch('view', '/view/%d' % self.buffer_id)
+        for path in STATIC_FILES:
+            self.fetch('static', path)
+        polls = 0
+        while time.time() < self.deadline:
+            self.fetch('query', '/api/query', {'buffer_id': self.buffer_id, 'timestamp': ''})
+            polls += 1
+            if polls % self.static_every == 0:
+                for path in STATIC_FILES:
+                    self.fetch('static', path)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog BUFFER_ID [options]')
+    parser.add_option('--url', default='http://127.0.0.1:51004')
+    parser.add_option('-n', '--clients', type='int', default=8)
+    parser.add_option('-d', '--duration', type='float', default=10.0)
+    parser.add_option('--static-every', type='int', default=10,
+                      help='reload static files every N polls')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('BUFFER_ID is required')
+
+    deadline = time.time() + options.duration
+    clients = [Client(options.url, int(args[0]), deadline, options.static_every)
+               for i in range(options.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+
+    latencies = {}
+    for client in clients:
+        for kind, values in client.latencies.items():
+            latencies.setdefault(kind, []).extend(values)
+    print('%d clients, %.1f s, %d errors' % (
+        options.clients, options.duration, sum(client.errors for client in clients)))
+    for kind in sorted(latencies):
+        values = latencies[kind]
+        print('%-8s %7d requests  p50 %8.2f ms  p99 %8.2f ms  max %8.2f ms' % (
+            kind, len(values), percentile(values, 50) * 1000,
+            percentile(values, 99) * 1000, max(values) * 1000))
+    try:
+        stats = json.loads(urlopen(options.url + '/api/stats').read().decode('utf-8'))
+    except Exception:
+        return
+    print('server: ' + ', '.join('%s=%s' % (k, stats[k]) for k in sorted(stats)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
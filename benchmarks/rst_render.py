@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Micro-benchmark for the per-render overhead of RstRenderer.
+
+Compares `publish_parts()`, which parses settings (and reads config files),
+and builds a new reader, parser and writer for each call, against
+RstRenderer, which sets all of them up once and reuses them between
+documents.
+
+Usage: python benchmarks/rst_render.py [reStructuredText files...]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+LIBS = os.path.join(ROOT, 'OmniMarkupLib', 'Renderers', 'libs')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, LIBS)
+sys.path.insert(0, os.path.join(LIBS, 'python3' if sys.version_info >= (3, 0, 0) else 'python2'))
+
+from docutils.core import publish_parts
+from OmniMarkupLib.Renderers.RstRenderer import GitHubHTMLTranslator, RstRenderer, Writer
+
+SMALL_DOC = u'Title\n=====\n\nSome *text* with ``code``.\n\n.. code:: python\n\n   print(1)\n'
+SECTION = u'''Section %d
+----------
+
+A paragraph with *emphasis*, **strong** text, a `link <http://example.com/>`_
+and ``inline literals``.
+
+* item one
+* item two
+
+  * nested item
+
+.. code:: python
+
+   def f(x):
+       return x * %d
+
++-------+-------+
+| cell  | cell  |
++=======+=======+
+| %d    | value |
++-------+-------+
+
+'''
+
+
+def publish(text):
+    writer = Writer()
+    writer.translator_class = GitHubHTMLTranslator
+    settings_overrides = dict(RstRenderer.SETTINGS_OVERRIDES)
+    del settings_overrides['traceback']
+    return publish_parts(text, writer=writer, settings_overrides=settings_overrides)['html_body']
+
+
+def bench(name, text, number):
+    renderer = RstRenderer()
+    assert publish(text) == renderer.render(text)
+    t_publish = min(timeit.repeat(lambda: publish(text), number=number, repeat=5)) / number
+    t_renderer = min(timeit.repeat(lambda: renderer.render(text), number=number, repeat=5)) / number
+    print('%-32s publish_parts %8.3f ms  RstRenderer %8.3f ms  saved %8.3f ms/render' % (
+        name, t_publish * 1000, t_renderer * 1000, (t_publish - t_renderer) * 1000))
+
+
+def main(filenames):
+    bench('<empty>', u'', 100)
+    bench('<small>', SMALL_DOC, 100)
+    for sections in (10, 100):
+        bench('<%d sections>' % sections,
+              u'Title\n=====\n\n' + u''.join(SECTION % (i, i, i) for i in range(sections)),
+              max(1, 200 // sections))
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            text = f.read().decode('utf-8')
+        bench(os.path.basename(filename), text, 10)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
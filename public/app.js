@@ -64,6 +64,82 @@ $(function() {
   var pollingInterval = window.App.Options.ajax_polling_interval
   var mathJaxEnabled = window.App.Options.mathjax_enabled
   var disconnected = false
+  // Set once the server reports it can hold queries until content changes
+  var longPolling = false
+  // Whether top-level elements of the content are tagged with block ids, so
+  // the server may send patches instead of the whole content
+  var patchable = false
+  // Last HTML received as a whole, base for deltas
+  var deltaBase = null
+  var deltaBaseHtml = null
+
+  // Rebuild the HTML from `deltaBaseHtml` and a line-based delta
+  var applyDelta = function(delta) {
+    var lines = deltaBaseHtml.match(/[^\n]*\n|[^\n]+$/g) || []
+    var parts = []
+    $.each(delta, function(i, op) {
+      if (typeof op === 'string') {
+        parts.push(op)
+      } else {
+        parts.push(lines.slice(op[0], op[1]).join(''))
+      }
+    })
+    return parts.join('')
+  }
+
+  var tagBlocks = function(content$, blockIds) {
+    var children = content$.children()
+    patchable = !!blockIds && children.length === blockIds.length
+    if (patchable) {
+      children.each(function(i) {
+        this.setAttribute('data-block-id', blockIds[i])
+      })
+    }
+  }
+
+  // Reorder, insert and remove top-level elements as listed in `blocks`,
+  // returns the inserted elements, or null if the patch can't be applied
+  var applyPatch = function(content$, blocks) {
+    var content = content$[0]
+    var existing = {}
+    content$.children().each(function() {
+      existing[this.getAttribute('data-block-id')] = this
+    })
+
+    var nodes = []
+    var added = []
+    for (var i = 0; i < blocks.length; i++) {
+      var block = blocks[i]
+      var node
+      if (typeof block === 'string') {
+        node = existing[block]
+        delete existing[block]
+      } else {
+        node = $($.parseHTML(block.html)).filter('*')[0]
+        if (node) {
+          node.setAttribute('data-block-id', block.id)
+          added.push(node)
+        }
+      }
+      if (!node) {
+        return null
+      }
+      nodes.push(node)
+    }
+
+    var ref = content.firstElementChild
+    $.each(nodes, function(i, node) {
+      if (node === ref) {
+        ref = ref.nextElementSibling
+      } else {
+        content.insertBefore(node, ref)
+      }
+    })
+    $.each(existing, function(id, node) {
+      content.removeChild(node)
+    })
+    return added
+  }
 
   var reviveBuffer = function() {
     var request = {
@@ -96,7 +172,10 @@ $(function() {
     var content$ = $('#content')
     var request = {
       buffer_id: window.App.Context.buffer_id,
-      timestamp: window.App.Context.timestamp
+      timestamp: window.App.Context.timestamp,
+      wait: longPolling,
+      patchable: patchable,
+      delta_base: deltaBase
     }
 
     setTimeout(function() {
@@ -112,6 +191,7 @@ $(function() {
           return
         }
 
+        longPolling = !!data.long_polling
         switch (data.status) {
         case 'UNCHANGED':
           break
@@ -119,17 +199,35 @@ $(function() {
           disconnected = true
           break
         case 'OK':
+        case 'DELTA':
+        case 'PATCH':
           var oldScrollProps = getVerticalScrollProperties()
+          // Only new elements need to be typeset and waited for
+          var updated$ = content$
+          if (data.status === 'PATCH') {
+            var added = applyPatch(content$, data.blocks)
+            if (added === null) {
+              // Out of sync, get the whole content next time
+              patchable = false
+              break
+            }
+            updated$ = $(added)
+          } else {
+            var html = data.status === 'DELTA' ? applyDelta(data.delta) : data.html_part
+            deltaBase = data.timestamp
+            deltaBaseHtml = html
+            // Replace content with latest one
+            content$.empty().html(html)
+            tagBlocks(content$, data.block_ids)
+          }
           // Fill the filename
           document.title = data.filename + '\u2014' + data.dirname
           $('#filename').text(data.filename)
-          // Replace content with latest one
-          content$.empty().html(data.html_part)
           window.App.Context.timestamp = data.timestamp
           window.App.Context.revivable_key = data.revivable_key
 
           // dirty hack for auto scrolling if images exist
-          var img$ = $('img')
+          var img$ = updated$.find('img').add(updated$.filter('img'))
           var doAutoScroll
           if (img$.length) {
             doAutoScroll = function() {
@@ -145,7 +243,12 @@ $(function() {
           }
 
           // typeset for MathJax
-          if (mathJaxEnabled) {
+          if (mathJaxEnabled && data.status === 'PATCH') {
+            updated$.each(function() {
+              MathJax.Hub.Queue(['Typeset', MathJax.Hub, this])
+            })
+            MathJax.Hub.Queue(doAutoScroll)
+          } else if (mathJaxEnabled) {
             MathJax.Hub.Queue(
               ['resetEquationNumbers', MathJax.InputJax.TeX], ['Typeset', MathJax.Hub, content$[0]],
               doAutoScroll)
@@ -157,6 +260,7 @@ $(function() {
       }).fail(function() {
         // Status <- Offline
         // console.log('Offline')
+        longPolling = false
       }).always(function() {
         if (!disconnected) {
           poll()
@@ -164,7 +268,7 @@ $(function() {
           reviveBuffer()
         }
       })
-    }, pollingInterval)
+    }, longPolling ? 0 : pollingInterval)
   }
 
   // Start polling once page started